@@ -415,6 +415,7 @@ async function dispatchAPI(path, params, headers, payload) {
         case '/discord/presence_update': return dispatchAPIAuthorized(headers, () => endpoint_discord_presence_update.handle(payload));
         case '/discord/typing_start': return dispatchAPIAuthorized(headers, () => endpoint_discord_typing_start.handle(payload));
         case '/voice_callback/voice_audio': return dispatchAPIAuthorized(headers, () => endpoint_discord_voice_audio.handle(payload));
+        case '/voice_callback/voice_audio_batch': return dispatchAPIAuthorized(headers, () => Promise.all(payload.map(item => endpoint_discord_voice_audio.handle(item))).then(() => undefined));
         case '/voice_callback/voice_playback_finished': return dispatchAPIAuthorized(headers, () => endpoint_discord_voice_playback_finished.handle(payload));
         case '/voice_callback/voice_reconnect': return dispatchAPIAuthorized(headers, () => endpoint_discord_voice_reconnect.handle(payload));
         case '/discord/voice_server_update': return dispatchAPIAuthorized(headers, () => endpoint_discord_voice_server_update.handle(payload));
@@ -0,0 +1,288 @@
+# end-to-end benchmark of the voice service without discord
+# runs local stand-ins for the discord voice gateway (websocket) and voice server (udp), connects N guilds through the real http routes,
+# plays a track in every guild and measures what arrives at the voice server
+#
+#   python benchmark.py --guilds 1,10,50 --duration 30 > result.json
+#
+# the steps in --guilds are cumulative (the 10 guilds of the first step keep streaming while 40 more connect)
+# the stand-ins run in a separate process, so cpu, memory and scheduling jitter measured in this process belong to the service alone
+# all settings of the service (like VOICE_ENGINE or VOICE_SENDER) are taken from the environment as usual
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import struct
+import asyncio
+import argparse
+import resource
+import tempfile
+import threading
+import http.server
+import multiprocessing
+import websockets
+
+frame_duration_ns = 20 * 1000 * 1000
+
+class VoiceGatewayStandIn:
+    # answers just enough of the voice gateway protocol (hello, ready, session description, heartbeat ack) to get a connection streaming
+    loop = None
+    port = None
+    udp_port = None
+    ssrc = 0
+
+    def __init__(self, udp_port):
+        self.udp_port = udp_port
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        threading.Thread(target=self.__run, args=(started,), daemon=True).start()
+        started.wait()
+
+    def __run(self, started):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.__serve(started))
+
+    async def __serve(self, started):
+        async with websockets.serve(self.__handle, '127.0.0.1', 0) as server:
+            self.port = list(server.sockets)[0].getsockname()[1]
+            started.set()
+            await asyncio.Future()
+
+    async def __handle(self, ws):
+        # the service drops its connections without a close frame when the benchmark ends, which is fine
+        try:
+            await ws.send(json.dumps({ 'op': 8, 'd': { 'heartbeat_interval': 41250 } }))
+            async for message in ws:
+                payload = json.loads(message)
+                match payload['op']:
+                    case 0:
+                        self.ssrc += 1
+                        await ws.send(json.dumps({ 'op': 2, 'd': { 'ssrc': self.ssrc, 'ip': '127.0.0.1', 'port': self.udp_port, 'modes': [ 'aead_aes256_gcm_rtpsize', 'aead_xchacha20_poly1305_rtpsize', 'xsalsa20_poly1305' ] } }))
+                    case 1:
+                        await ws.send(json.dumps({ 'op': 4, 'd': { 'mode': payload['d']['data']['mode'], 'secret_key': [ random.randint(0, 255) for _ in range(32) ] } }))
+                    case 3:
+                        await ws.send(json.dumps({ 'op': 6, 'd': payload['d'] }))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def get_endpoint(self):
+        return 'ws://127.0.0.1:' + str(self.port)
+
+class VoiceServerStandIn:
+    # receives the voice packets and records their arrival per ssrc
+    socket = None
+    port = None
+    arrivals = None
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024 * 16)
+        self.socket.bind(('127.0.0.1', 0))
+        self.port = self.socket.getsockname()[1]
+        self.arrivals = {}
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def __run(self):
+        while True:
+            package = self.socket.recv(65535)
+            now = time.monotonic_ns()
+            if len(package) < 12:
+                continue
+            sequence, timestamp, ssrc = struct.unpack_from('>HII', package, 2)
+            arrivals = self.arrivals.get(ssrc)
+            if arrivals is None:
+                arrivals = self.arrivals[ssrc] = []
+            arrivals.append(now)
+
+    def snapshot(self):
+        return { ssrc: len(arrivals) for ssrc, arrivals in list(self.arrivals.items()) }
+
+    def window(self, counts_before, end):
+        # frames, late frames and sorted send jitter of everything that arrived since the snapshot until end
+        jitter = []
+        late = 0
+        frames = 0
+        for ssrc, arrivals in list(self.arrivals.items()):
+            window = [arrival for arrival in arrivals[counts_before.get(ssrc, 0):] if arrival <= end]
+            frames += len(window)
+            for previous, current in zip(window, window[1:]):
+                deviation = current - previous - frame_duration_ns
+                jitter.append(abs(deviation) / 1000 / 1000)
+                if deviation > frame_duration_ns:
+                    late += 1
+        jitter.sort()
+        return frames, late, jitter
+
+class CallbackStandIn(http.server.BaseHTTPRequestHandler):
+    # accepts every callback, the benchmark doesnt care about them
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('content-length', '0')))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_stand_ins(connection):
+    # entry point of the stand-in process, answers requests of StandIns until the benchmark ends
+    voice_server = VoiceServerStandIn()
+    gateway = VoiceGatewayStandIn(voice_server.port)
+    callbacks = http.server.ThreadingHTTPServer(('127.0.0.1', 0), CallbackStandIn)
+    threading.Thread(target=callbacks.serve_forever, daemon=True).start()
+    connection.send((gateway.get_endpoint(), callbacks.server_port))
+    while True:
+        try:
+            request, args = connection.recv()
+        except EOFError:
+            return
+        match request:
+            case 'snapshot':
+                connection.send(voice_server.snapshot())
+            case 'window':
+                connection.send(voice_server.window(*args))
+
+class StandIns:
+    # runs the voice gateway, voice server and callback stand-ins in a separate process and queries their observations over a pipe
+    process = None
+    connection = None
+    endpoint = None
+    callback_port = None
+
+    def __init__(self):
+        context = multiprocessing.get_context('spawn')
+        self.connection, remote = context.Pipe()
+        self.process = context.Process(target=serve_stand_ins, args=(remote,), daemon=True)
+        self.process.start()
+        self.endpoint, self.callback_port = self.connection.recv()
+
+    def __request(self, request, *args):
+        self.connection.send((request, args))
+        return self.connection.recv()
+
+    def snapshot(self):
+        return self.__request('snapshot')
+
+    def window(self, counts_before, end):
+        return self.__request('window', counts_before, end)
+
+    def get_endpoint(self):
+        return self.endpoint
+
+def create_synthetic_track(voice, url, frames, frame_size):
+    # writes a track straight into the cache so the benchmark needs neither network nor ffmpeg nor libopus, the streamer does not look into the frames anyway
+    path = voice.STORAGE_DIRECTORY + '/' + voice.get_cache_filename_prefix(url) + '.' + voice.PACKET_FILE_EXTENSION
+    writer = voice.PacketFileWriter(path)
+    for _ in range(frames):
+        writer.write(b'\xFC' + random.randbytes(frame_size - 1)) # TOC of a 20ms stereo CELT frame
+    writer.close()
+    voice.cache_index.add(path)
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def measure(stand_ins, duration, guilds):
+    # the monotonic clock is shared by all processes, so the arrivals recorded by the stand-ins can be cut at our end of the measurement
+    counts_before = stand_ins.snapshot()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.monotonic_ns()
+    time.sleep(duration)
+    end = time.monotonic_ns()
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    frames, late, jitter = stand_ins.window(counts_before, end)
+    seconds = (end - start) / 1000 / 1000 / 1000
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    rss = 0
+    try:
+        with open('/proc/self/statm') as file:
+            rss = int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        pass
+    return {
+        'guilds': guilds,
+        'duration_secs': seconds,
+        'frames': frames,
+        'frames_per_sec': frames / seconds,
+        'frames_per_sec_expected': guilds * 1000 * 1000 * 1000 / frame_duration_ns,
+        'late_frames': late,
+        'send_jitter_ms': {
+            'p50': percentile(jitter, 0.5),
+            'p90': percentile(jitter, 0.9),
+            'p99': percentile(jitter, 0.99),
+            'p999': percentile(jitter, 0.999),
+            'max': jitter[-1] if jitter else None
+        },
+        'cpu_secs_per_sec': cpu / seconds,
+        'cpu_secs_per_sec_per_guild': cpu / seconds / guilds,
+        'memory_rss_bytes': rss,
+        'memory_max_rss_bytes': usage_after.ru_maxrss * 1024
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description = 'end-to-end benchmark of the voice service')
+    parser.add_argument('--guilds', default = '1,10,50', help = 'comma separated, cumulative number of guilds to measure')
+    parser.add_argument('--duration', type = float, default = 30, help = 'seconds to measure per step')
+    parser.add_argument('--warmup', type = float, default = 5, help = 'seconds to wait after connecting before measuring')
+    parser.add_argument('--source', default = None, help = 'url of a track to play instead of a synthetic one (needs ffmpeg and network)')
+    parser.add_argument('--frame-size', type = int, default = 160, help = 'bytes per frame of the synthetic track')
+    arguments = parser.parse_args()
+    steps = [ int(step) for step in arguments.guilds.split(',') ]
+
+    directory = tempfile.mkdtemp(prefix = 'philbot-voice-benchmark.')
+    os.environ.setdefault('CACHE_DIRECTORY', directory)
+    os.environ.setdefault('STATE_STORAGE_DIRECTORY', directory)
+    os.environ.setdefault('DISCORD_API_TOKEN', 'benchmark')
+    os.environ.setdefault('PUBLIC_IP', '127.0.0.1')
+
+    # the service logs to stdout, keep it for the results
+    results = sys.stdout
+    sys.stdout = sys.stderr
+
+    stand_ins = StandIns()
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'philbot-voice'))
+    import voice
+    voice.start()
+
+    url = arguments.source
+    if not url:
+        url = 'https://benchmark.invalid/synthetic'
+        create_synthetic_track(voice, url, int((sum(arguments.duration + arguments.warmup for _ in steps) + 60) * 50), arguments.frame_size)
+
+    client = voice.app.test_client()
+    headers = { 'x-authorization': os.environ['DISCORD_API_TOKEN'] }
+    connected = 0
+    output = []
+    for step in steps:
+        began = time.time()
+        for guild in range(connected, step):
+            guild_id = str(1000000 + guild)
+            client.post('/events/voice_state_update', headers = headers, json = { 'guild_id': guild_id, 'channel_id': '1', 'user_id': '2', 'session_id': 'benchmark' + guild_id, 'callback_url': 'http://127.0.0.1:' + str(stand_ins.callback_port) })
+            client.post('/events/voice_server_update', headers = headers, json = { 'guild_id': guild_id, 'endpoint': stand_ins.get_endpoint(), 'token': 'benchmark' })
+            response = client.post('/guilds/' + guild_id + '/voice/content', headers = headers, json = { 'url': url })
+            if response.status_code != 200:
+                raise RuntimeError('cannot play in guild ' + guild_id + ': ' + str(response.status_code))
+        connected = step
+        streaming = 0
+        while streaming < connected:
+            if time.time() - began > 60:
+                raise RuntimeError('only ' + str(streaming) + ' of ' + str(connected) + ' guilds are streaming')
+            time.sleep(0.1)
+            streaming = len(stand_ins.snapshot())
+        setup = time.time() - began
+        time.sleep(arguments.warmup)
+        result = measure(stand_ins, arguments.duration, connected)
+        result['setup_secs'] = setup
+        print('BENCHMARK ' + json.dumps(result))
+        output.append(result)
+
+    results.write(json.dumps({ 'settings': { 'VOICE_ENGINE': voice.VOICE_ENGINE, 'VOICE_SENDER': voice.VOICE_SENDER, 'frame_size': arguments.frame_size, 'source': arguments.source }, 'results': output }, indent = 2) + '\n')
+    results.flush()
+    os._exit(0) # the service threads never end
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# microbenchmarks of the per-frame primitives of the voice service (packet crypto and opus), single and batched
+# reports nanoseconds per frame and peak bytes allocated per frame (the most memory that was live at once during a call, divided by its frames)
+#
+#   python microbenchmark.py --frames 5000 > result.json
+#
+# the opus benchmarks are skipped if libopus is not available
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+def run(name, function, frames_per_call, iterations):
+    function() # warm up
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        function()
+    duration = time.perf_counter_ns() - start
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    result = function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    measurement = {
+        'name': name,
+        'frames': frames_per_call * iterations,
+        'ns_per_frame': duration / (frames_per_call * iterations),
+        'peak_bytes_per_frame': (peak - baseline) / frames_per_call
+    }
+    print('MICROBENCHMARK ' + json.dumps(measurement))
+    return measurement
+
+def main():
+    parser = argparse.ArgumentParser(description = 'microbenchmarks of the voice packet and codec primitives')
+    parser.add_argument('--frames', type = int, default = 5000, help = 'frames per benchmark')
+    parser.add_argument('--batch', type = int, default = 50, help = 'frames per batch')
+    parser.add_argument('--frame-size', type = int, default = 160, help = 'bytes per opus frame')
+    arguments = parser.parse_args()
+
+    os.environ.setdefault('CACHE_DIRECTORY', tempfile.mkdtemp(prefix = 'philbot-voice-microbenchmark.'))
+    results = sys.stdout
+    sys.stdout = sys.stderr
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'philbot-voice'))
+    import voice
+    import nacl.secret
+    import nacl.utils
+    import pyogg
+
+    secret_box = nacl.secret.SecretBox(nacl.utils.random(nacl.secret.SecretBox.KEY_SIZE))
+    batch = arguments.batch
+    batches = max(1, arguments.frames // batch)
+    opus_frames = [ b'\xFC' + random.randbytes(arguments.frame_size - 1) for _ in range(batch) ]
+    packages = [ voice.create_voice_package(sequence, sequence * voice.desired_frame_size, 1, secret_box, opus_frame) for sequence, opus_frame in enumerate(opus_frames) ]
+    output = []
+
+    def create_single():
+        return [ voice.create_voice_package(sequence, sequence * voice.desired_frame_size, 1, secret_box, opus_frame) for sequence, opus_frame in enumerate(opus_frames) ]
+    builder = voice.PacketBuilder(1, bytes(secret_box))
+    def create_builder():
+        for sequence, opus_frame in enumerate(opus_frames):
+            builder.build(sequence, sequence * voice.desired_frame_size, opus_frame)
+    def unwrap_single():
+        return [ voice.unwrap_voice_package(package, secret_box) for package in packages ]
+    output.append(run('create_voice_package', create_single, batch, batches))
+    output.append(run('PacketBuilder.build', create_builder, batch, batches))
+    output.append(run('unwrap_voice_package', unwrap_single, batch, batches))
+
+    for mode in [ 'xsalsa20_poly1305', 'aead_xchacha20_poly1305_rtpsize', 'aead_aes256_gcm_rtpsize' ]:
+        mode_builder = voice.PacketBuilder(1, bytes(secret_box), mode)
+        mode_opener = voice.PacketOpener(bytes(secret_box), mode)
+        mode_packages = [ bytes(mode_builder.build(sequence, sequence * voice.desired_frame_size, opus_frame)) for sequence, opus_frame in enumerate(opus_frames) ]
+        def build_packages():
+            for sequence, opus_frame in enumerate(opus_frames):
+                mode_builder.build(sequence, sequence * voice.desired_frame_size, opus_frame)
+        def open_packages():
+            return [ mode_opener.open(package) for package in mode_packages ]
+        output.append(run('PacketBuilder.build[' + mode + ']', build_packages, batch, batches))
+        output.append(run('PacketOpener.open[' + mode + ']', open_packages, batch, batches))
+
+    if pyogg.PYOGG_OPUS_AVAIL:
+        frame_bytes = voice.desired_frame_size * voice.channels * voice.sample_width
+        pcm = random.randbytes(frame_bytes * batch)
+        encoder = voice.PacketEncoder()
+        encoded = encoder.encode_batch(pcm)
+        decoders = voice.DecoderPool()
+        def encode_single():
+            return [ encoder.encode(pcm[offset:offset + frame_bytes]) for offset in range(0, len(pcm), frame_bytes) ]
+        def encode_batch():
+            return encoder.encode_batch(pcm)
+        def decode_single():
+            return b''.join(decoders.decode(1, opus_frame) for opus_frame in encoded)
+        def decode_batch():
+            return decoders.decode_batch(1, [ (opus_frame, 0) for opus_frame in encoded ])
+        output.append(run('opus_encode', encode_single, batch, batches))
+        output.append(run('opus_encode_batch', encode_batch, batch, batches))
+        output.append(run('opus_decode', decode_single, batch, batches))
+        output.append(run('opus_decode_batch', decode_batch, batch, batches))
+        encoder.close()
+        decoders.close()
+    else:
+        print('MICROBENCHMARK skipping opus (not available)')
+
+    results.write(json.dumps({ 'settings': { 'batch': batch, 'frame_size': arguments.frame_size, 'hardware_aes256gcm': voice.has_hardware_aes256gcm() }, 'results': output }, indent = 2) + '\n')
+    results.flush()
+    os._exit(0) # the service threads never end
+
+if __name__ == '__main__':
+    main()
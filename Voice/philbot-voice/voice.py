@@ -1,20 +1,39 @@
 import uuid
+import hashlib
 import os
+import sys
+import signal
+import resource
 import io
 import time
+import math
 import random
 import json
 import struct
 import ctypes
 import nacl.secret
+import nacl.bindings
+from nacl._sodium import ffi as sodium_ffi, lib as sodium_lib
+import nacl.exceptions
+import cryptography.exceptions
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import wave
 import pyogg
 import pyogg.opus
 import threading
+import numpy
+import heapq
+import collections
+import asyncio
+import concurrent.futures
 import socket
 import requests
+import urllib.parse
 import subprocess
+import shutil
+import fcntl
 import websocket
+import websockets
 from flask import Flask, request, Response, send_file
 import yt_dlp
 import opentelemetry
@@ -146,12 +165,84 @@ def observed_subprocess_run(command):
         span.set_attribute('subprocess.exit_code', completed_process.returncode)
         return completed_process
 
+def observed_subprocess_stream(command, consume):
+    with opentelemetry.trace.get_tracer('philbot-voice/subprocess').start_as_current_span(' '.join(command)) as span:
+        span.set_attribute("subprocess.command", ' '.join(command))
+        span.set_attribute("subprocess.command_args", ' '.join(command[1:]))
+        span.set_attribute("subprocess.executable.path", command[0] if '/' in command[0] else "")
+        span.set_attribute("subprocess.executable.name", command[0].rsplit('/', 1)[-1] if '/' in command else command[0])
+        carrier = {}
+        TraceContextTextMapPropagator().inject(carrier, opentelemetry.trace.set_span_in_context(span, None))
+        env = os.environ.copy()
+        env["OTEL_TRACEPARENT"] = carrier['traceparent']
+        process = subprocess.Popen(command, env=env, stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        try:
+            consume(process.stdout)
+        finally:
+            process.stdout.close()
+            if process.poll() is None:
+                process.kill()
+            returncode = process.wait()
+        span.set_attribute('subprocess.exit_code', returncode)
+        return returncode
+
 UDP_MAX_PAYLOAD = 65507
 HTTP_PORT = int(os.environ.get('PORT', str(8080)))
 UDP_PORT_MIN = int(os.environ.get('UDP_PORT_MIN', str(12346)))
 UDP_PORT_MAX = int(os.environ.get('UDP_PORT_MAX', str(65535)))
+PUBLIC_IP = os.environ.get('PUBLIC_IP') # discovered on every connect if not set
 STORAGE_DIRECTORY = os.environ['CACHE_DIRECTORY']
 SESSION_DIRECTORY = os.environ.get('STATE_STORAGE_DIRECTORY', '.')
+VOICE_WORKERS = int(os.environ.get('VOICE_WORKERS', str(1))) # more than one runs a supervisor that shards guilds across worker processes
+VOICE_WORKER = os.environ.get('VOICE_WORKER') # index of this worker, set by the supervisor
+CACHE_OWNER = VOICE_WORKER is None or VOICE_WORKER == '0' # workers share the cache directory, only one of them enforces the budget, sweeps and persists the index
+DOWNLOAD_LOCK_STRIPES = int(os.environ.get('DOWNLOAD_LOCK_STRIPES', str(256)))
+VOICE_WORKER_PORT_BASE = int(os.environ.get('VOICE_WORKER_PORT_BASE', str(HTTP_PORT + 1)))
+VOICE_WORKER_RESTART_DELAY = int(os.environ.get('VOICE_WORKER_RESTART_DELAY', str(1000 * 5)))
+PROGRESSIVE_PLAYBACK = os.environ.get('PROGRESSIVE_PLAYBACK', 'false') == 'true'
+PROGRESSIVE_PREBUFFER_FRAMES = int(os.environ.get('PROGRESSIVE_PREBUFFER_FRAMES', str(15)))
+VOICE_ENGINE = os.environ.get('VOICE_ENGINE', 'threads')
+VOICE_ENGINE_WORKERS = int(os.environ.get('VOICE_ENGINE_WORKERS', str(8)))
+VOICE_ENGINE_MEDIA_WORKERS = int(os.environ.get('VOICE_ENGINE_MEDIA_WORKERS', str(4)))
+VOICE_ENGINE_CONVERSION_WORKERS = int(os.environ.get('VOICE_ENGINE_CONVERSION_WORKERS', str(2)))
+LISTEN_QUEUE_CAPACITY = int(os.environ.get('LISTEN_QUEUE_CAPACITY', str(1024)))
+VOICE_SENDER = os.environ.get('VOICE_SENDER', 'connection')
+JITTER_BUFFER_CAPACITY = int(os.environ.get('JITTER_BUFFER_CAPACITY', str(512)))
+DECODER_POOL_MAX = int(os.environ.get('DECODER_POOL_MAX', str(64)))
+DECODER_IDLE_TIMEOUT = int(os.environ.get('DECODER_IDLE_TIMEOUT', str(1000 * 60)))
+MAX_CONCEALED_FRAMES = int(os.environ.get('MAX_CONCEALED_FRAMES', str(5)))
+CONVERSION_BATCH_FRAMES = int(os.environ.get('CONVERSION_BATCH_FRAMES', str(50)))
+VOICE_ENCRYPTION_MODES = os.environ.get('VOICE_ENCRYPTION_MODES', 'aead_aes256_gcm_rtpsize,aead_xchacha20_poly1305_rtpsize,xsalsa20_poly1305').split(',')
+IDLE_SILENCE_FRAMES = int(os.environ.get('IDLE_SILENCE_FRAMES', str(5)))
+NORMALIZATION_TARGET_DBFS = float(os.environ.get('NORMALIZATION_TARGET_DBFS', str(-20)))
+NORMALIZATION_MAX_GAIN = float(os.environ.get('NORMALIZATION_MAX_GAIN', str(4)))
+NORMALIZATION_SMOOTHING = float(os.environ.get('NORMALIZATION_SMOOTHING', str(0.05)))
+RECORDING_FORMAT = os.environ.get('RECORDING_FORMAT', 'mp3')
+VAD_ENABLED = os.environ.get('VAD_ENABLED', 'false') == 'true'
+VAD_THRESHOLD_DBFS = float(os.environ.get('VAD_THRESHOLD_DBFS', str(-50)))
+VAD_MIN_PACKET_SIZE = int(os.environ.get('VAD_MIN_PACKET_SIZE', str(16)))
+VAD_MIN_VOICED_DURATION = int(os.environ.get('VAD_MIN_VOICED_DURATION', str(500)))
+VAD_HANGOVER = int(os.environ.get('VAD_HANGOVER', str(300)))
+VAD_MAX_PAUSE = int(os.environ.get('VAD_MAX_PAUSE', str(1000)))
+CALLBACK_WORKERS = int(os.environ.get('CALLBACK_WORKERS', str(4)))
+CALLBACK_QUEUE_SIZE = int(os.environ.get('CALLBACK_QUEUE_SIZE', str(1000)))
+CALLBACK_SPILL_DIRECTORY = os.environ.get('CALLBACK_SPILL_DIRECTORY', SESSION_DIRECTORY)
+CALLBACK_BATCH_SIZE = int(os.environ.get('CALLBACK_BATCH_SIZE', str(1)))
+CALLBACK_MAX_AGE = int(os.environ.get('CALLBACK_MAX_AGE', str(1000 * 60 * 60 * 2)))
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', str(4)))
+DOWNLOAD_BANDWIDTH_LIMIT = int(os.environ.get('DOWNLOAD_BANDWIDTH_LIMIT', str(0))) # bytes per second over all downloads, 0 means unlimited
+DOWNLOAD_TIMEOUT = int(os.environ.get('DOWNLOAD_TIMEOUT', str(30))) # seconds without progress
+DOWNLOAD_RETRIES = int(os.environ.get('DOWNLOAD_RETRIES', str(3)))
+DOWNLOAD_MAX_SIZE = int(os.environ.get('DOWNLOAD_MAX_SIZE', str(1024 * 1024 * 512)))
+DOWNLOAD_REVALIDATE_INTERVAL = int(os.environ.get('DOWNLOAD_REVALIDATE_INTERVAL', str(1000 * 60 * 60 * 24)))
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', str(2)))
+PREFETCH_QUEUE_SIZE = int(os.environ.get('PREFETCH_QUEUE_SIZE', str(100)))
+PREFETCH_STATUS_MAX_AGE = int(os.environ.get('PREFETCH_STATUS_MAX_AGE', str(1000 * 60 * 60)))
+CACHE_BUDGET_BYTES = int(os.environ.get('CACHE_BUDGET_BYTES', str(1024 * 1024 * 1024 * 2)))
+CACHE_EVICTION_POLICY = os.environ.get('CACHE_EVICTION_POLICY', 'lru')
+CACHE_TEMPORARY_MAX_AGE = int(os.environ.get('CACHE_TEMPORARY_MAX_AGE', str(1000 * 60 * 15)))
+CACHE_SWEEP_INTERVAL = int(os.environ.get('CACHE_SWEEP_INTERVAL', str(1000 * 60 * 60)))
+FRAME_SCHEDULER_MAX_CATCH_UP = int(os.environ.get('FRAME_SCHEDULER_MAX_CATCH_UP', str(5)))
 
 meter = opentelemetry.metrics.get_meter_provider().get_meter('voice', '1.0.0')
 app = Flask(__name__)
@@ -167,7 +258,7 @@ def create_voice_package_header(sequence, timestamp, ssrc):
     header[0] = 0x80
     header[1] = 0x78
     struct.pack_into('>H', header, 2, sequence & 0xFFFF)
-    struct.pack_into('>I', header, 4, timestamp)
+    struct.pack_into('>I', header, 4, timestamp & 0xFFFFFFFF)
     struct.pack_into('>I', header, 8, ssrc)
     return bytes(header)
 
@@ -194,14 +285,528 @@ def unwrap_voice_package(package, secret_box):
         voice_chunk = voice_chunk[2 + 2 + 4 * extension_length:]
     return sequence, timestamp, ssrc, voice_chunk
 
+def select_voice_mode(offered):
+    # the first of our modes (cheapest first) that the server offers
+    for mode in VOICE_ENCRYPTION_MODES:
+        if mode in offered:
+            return mode
+    raise RuntimeError('no supported mode offered: ' + ', '.join(offered))
+
+def has_hardware_aes256gcm():
+    return sodium_lib.crypto_aead_aes256gcm_is_available() == 1
+
+class PacketBuilder:
+    # builds the voice packages of one connection in place, header and nonce are updated rather than recreated and the ciphertext is written into a reused buffer
+    # the returned package is a view into that buffer, so it is only valid until the next call
+    # https://discord.com/developers/docs/topics/voice-connections#transport-encryption-modes
+    mode = None
+    key = None
+    header = None
+    nonce = None
+    nonce_pointer = None
+    counter = 0
+    overhead = 0
+    aesgcm = None
+    output = None
+    output_pointer = None
+
+    def __init__(self, ssrc, secret_key, mode = 'xsalsa20_poly1305', capacity = 4000):
+        self.mode = mode
+        self.key = bytes(secret_key)
+        match mode:
+            case 'xsalsa20_poly1305':
+                self.nonce = bytearray(24)
+                self.overhead = sodium_lib.crypto_secretbox_macbytes()
+            case 'aead_xchacha20_poly1305_rtpsize':
+                self.nonce = bytearray(24)
+                self.overhead = sodium_lib.crypto_aead_xchacha20poly1305_ietf_abytes() + 4 # the nonce counter is appended
+            case 'aead_aes256_gcm_rtpsize':
+                self.nonce = bytearray(12)
+                self.overhead = 16 + 4 # the nonce counter is appended
+                if not has_hardware_aes256gcm():
+                    self.aesgcm = AESGCM(self.key)
+            case _:
+                raise RuntimeError('unexpected mode: ' + mode)
+        self.nonce_pointer = sodium_ffi.from_buffer(self.nonce)
+        self.header = bytearray(12)
+        self.header[0] = 0x80
+        self.header[1] = 0x78
+        struct.pack_into('>I', self.header, 8, ssrc)
+        self.__allocate(capacity)
+
+    def __allocate(self, capacity):
+        self.output = bytearray(12 + self.overhead + capacity)
+        self.output[:12] = self.header
+        self.output_pointer = sodium_ffi.from_buffer(self.output)
+
+    def build(self, sequence, timestamp, voice_chunk):
+        # voice_chunk may be any contiguous buffer (like a memoryview into a packet file), libsodium gets a pointer into it without copying
+        length = 12 + self.overhead + len(voice_chunk)
+        if length > len(self.output):
+            self.__allocate(len(voice_chunk))
+        struct.pack_into('>HI', self.output, 2, sequence & 0xFFFF, timestamp & 0xFFFFFFFF)
+        plaintext = sodium_ffi.from_buffer('unsigned char[]', voice_chunk) if not self.aesgcm else voice_chunk
+        if self.mode == 'xsalsa20_poly1305':
+            sodium_ffi.memmove(self.nonce_pointer, self.output_pointer, 12)
+            result = sodium_lib.crypto_secretbox_easy(self.output_pointer + 12, plaintext, len(voice_chunk), self.nonce_pointer, self.key)
+        else:
+            self.counter = (self.counter + 1) & 0xFFFFFFFF
+            struct.pack_into('>I', self.nonce, 0, self.counter)
+            struct.pack_into('>I', self.output, length - 4, self.counter)
+            if self.mode == 'aead_xchacha20_poly1305_rtpsize':
+                result = sodium_lib.crypto_aead_xchacha20poly1305_ietf_encrypt(self.output_pointer + 12, sodium_ffi.NULL, plaintext, len(voice_chunk), self.output_pointer, 12, sodium_ffi.NULL, self.nonce_pointer, self.key)
+            elif not self.aesgcm:
+                result = sodium_lib.crypto_aead_aes256gcm_encrypt(self.output_pointer + 12, sodium_ffi.NULL, plaintext, len(voice_chunk), self.output_pointer, 12, sodium_ffi.NULL, self.nonce_pointer, self.key)
+            else:
+                self.output[12:length - 4] = self.aesgcm.encrypt(self.nonce, voice_chunk, memoryview(self.output)[:12])
+                result = 0
+        if result != 0:
+            raise RuntimeError('encryption failed')
+        return memoryview(self.output)[:length]
+
+class PacketOpener:
+    # decrypts the voice packages received on one connection, failures raise nacl.exceptions.CryptoError in all modes
+    mode = None
+    key = None
+    nonce = None
+    aesgcm = None
+
+    def __init__(self, secret_key, mode = 'xsalsa20_poly1305'):
+        self.mode = mode
+        self.key = bytes(secret_key)
+        match mode:
+            case 'xsalsa20_poly1305' | 'aead_xchacha20_poly1305_rtpsize':
+                self.nonce = bytearray(24)
+            case 'aead_aes256_gcm_rtpsize':
+                self.nonce = bytearray(12)
+                if not has_hardware_aes256gcm():
+                    self.aesgcm = AESGCM(self.key)
+            case _:
+                raise RuntimeError('unexpected mode: ' + mode)
+
+    def open(self, package):
+        sequence, timestamp, ssrc = struct.unpack_from('>HII', package, 2)
+        if self.mode == 'xsalsa20_poly1305':
+            self.nonce[:12] = package[:12]
+            voice_chunk = nacl.bindings.crypto_secretbox_open(package[12:], bytes(self.nonce), self.key)
+            if voice_chunk[0] == 0xbe and voice_chunk[1] == 0xde: # RTP header extensions ...
+                extension_length = int.from_bytes(voice_chunk[2:2+2], byteorder='big')
+                voice_chunk = voice_chunk[2 + 2 + 4 * extension_length:]
+            return sequence, timestamp, ssrc, voice_chunk
+        # rtpsize modes authenticate the header (with CSRCs and the extension header, but not the extension itself) and append the nonce counter
+        header_size = 12 + 4 * (package[0] & 0x0F)
+        extension = package[0] & 0x10
+        if extension:
+            header_size += 4
+        header = package[:header_size]
+        self.nonce[:4] = package[-4:]
+        ciphertext = package[header_size:-4]
+        if self.mode == 'aead_xchacha20_poly1305_rtpsize':
+            voice_chunk = nacl.bindings.crypto_aead_xchacha20poly1305_ietf_decrypt(ciphertext, header, bytes(self.nonce), self.key)
+        elif not self.aesgcm:
+            voice_chunk = nacl.bindings.crypto_aead_aes256gcm_decrypt(ciphertext, header, bytes(self.nonce), self.key)
+        else:
+            try:
+                voice_chunk = self.aesgcm.decrypt(bytes(self.nonce), ciphertext, header)
+            except cryptography.exceptions.InvalidTag:
+                raise nacl.exceptions.CryptoError('decryption failed')
+        if extension:
+            extension_length = int.from_bytes(header[header_size - 2:header_size], byteorder='big')
+            voice_chunk = voice_chunk[4 * extension_length:]
+        return sequence, timestamp, ssrc, voice_chunk
+
 def generate_audio_file_path(guild_id, channel_id, user_id, nonce, extension = 'wav'):
     path = STORAGE_DIRECTORY + '/audio.in.' + guild_id + '.' + channel_id + '.' + user_id + '.' + str(nonce) + '.' + extension
     if not os.path.normpath(path).startswith(STORAGE_DIRECTORY):
         raise RuntimeError
     return path
 
-download_lock = threading.Lock()
-downloads = {}
+counter_cache_hits = meter.create_counter(name = 'discord.gateway.voice.cache.hits', description = 'Number of cache lookups that found a cached file', unit="count")
+counter_cache_misses = meter.create_counter(name = 'discord.gateway.voice.cache.misses', description = 'Number of cache lookups that did not find a cached file', unit="count")
+counter_cache_evictions = meter.create_counter(name = 'discord.gateway.voice.cache.evictions', description = 'Number of files evicted from the cache', unit="count")
+
+class CacheEntry:
+    __slots__ = ('size', 'last_access', 'hits', 'pins', 'expires', 'metadata')
+
+    def __init__(self):
+        self.size = 0
+        self.last_access = time_millis()
+        self.hits = 0
+        self.pins = 0
+        self.expires = None
+        self.metadata = None
+
+class CacheIndex:
+    # keeps track of all files in the storage directory, evicts by a byte budget (least recently or least frequently used) and never evicts pinned files
+    lock = None
+    entries = None
+    size = 0
+    dirty = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def load(self):
+        persisted = {}
+        try:
+            with open(CACHE_INDEX_FILE, 'r') as file:
+                persisted = json.loads(file.read())
+        except FileNotFoundError:
+            pass
+        except Exception as exception:
+            print('VOICE CACHE cannot read index: ' + str(exception))
+        for entry in os.scandir(STORAGE_DIRECTORY):
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            self.add(entry.path, None if is_cache_file(entry.name) else CACHE_TEMPORARY_MAX_AGE, entry.stat().st_size)
+            state = persisted.get(entry.name)
+            if state:
+                with self.lock:
+                    cached = self.entries[entry.path]
+                    cached.last_access = state['last_access']
+                    cached.hits = state['hits']
+                    cached.metadata = state.get('metadata')
+        print('VOICE CACHE loaded ' + str(len(self.entries)) + ' files (' + str(self.size // 1024 // 1024) + 'MB)')
+
+    def save(self):
+        if not CACHE_OWNER:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            persisted = {}
+            for path, entry in self.entries.items():
+                if entry.expires is None and entry.size > 0:
+                    persisted[os.path.basename(path)] = { 'size': entry.size, 'last_access': entry.last_access, 'hits': entry.hits, 'metadata': entry.metadata }
+        with open(CACHE_INDEX_FILE + '.tmp', 'w') as file:
+            file.write(json.dumps(persisted))
+        os.replace(CACHE_INDEX_FILE + '.tmp', CACHE_INDEX_FILE)
+
+    def add(self, path, max_age = None, size = None, metadata = None):
+        if size is None:
+            size = os.path.getsize(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if not entry:
+                entry = self.entries[path] = CacheEntry()
+            self.size += size - entry.size
+            entry.size = size
+            entry.last_access = time_millis()
+            entry.expires = entry.last_access + max_age if max_age is not None else None
+            if metadata is not None:
+                entry.metadata = metadata
+            self.dirty = True
+        self.evict()
+
+    def get_metadata(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            return dict(entry.metadata) if entry and entry.metadata else None
+
+    def lookup(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry:
+                entry.last_access = time_millis()
+                entry.hits += 1
+                self.dirty = True
+        if not entry and VOICE_WORKER is not None and os.path.exists(path):
+            self.add(path) # written by another worker
+            entry = True
+        if entry and os.path.exists(path):
+            if not CACHE_OWNER:
+                touch(path) # tells the owner about the access
+            counter_cache_hits.add(1)
+            return True
+        if entry:
+            self.remove(path)
+        counter_cache_misses.add(1)
+        return False
+
+    def pin(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            if not entry:
+                entry = self.entries[path] = CacheEntry()
+            entry.pins += 1
+            entry.last_access = time_millis()
+        if not CACHE_OWNER:
+            touch(path)
+
+    def unpin(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry:
+                entry.pins = max(0, entry.pins - 1)
+                entry.last_access = time_millis()
+        if not CACHE_OWNER:
+            touch(path)
+
+    def remove(self, path):
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry:
+                self.size -= entry.size
+                self.dirty = True
+        try:
+            os.remove(path)
+        except:
+            pass
+
+    def refresh(self):
+        # the owner of a cache shared by several workers learns about the tracks the others write from the directory,
+        # and about their accesses from the modification times (they touch the files on lookup, pin and unpin)
+        # their pins are not visible here, but evicting a file they stream is safe since open files stay readable
+        entries = []
+        for entry in os.scandir(STORAGE_DIRECTORY):
+            if entry.is_file() and is_cache_file(entry.name):
+                stat = entry.stat()
+                entries.append((entry.path, stat.st_size, int(stat.st_mtime * 1000)))
+        with self.lock:
+            for path, size, modified in entries:
+                cached = self.entries.get(path)
+                if not cached:
+                    cached = self.entries[path] = CacheEntry()
+                    cached.last_access = modified
+                    self.size += size - cached.size
+                    cached.size = size
+                    self.dirty = True
+                elif modified > cached.last_access:
+                    cached.last_access = modified
+                    cached.hits += 1
+                    self.dirty = True
+
+    def evict(self):
+        if CACHE_OWNER and VOICE_WORKER is not None:
+            self.refresh()
+        victims = []
+        with self.lock:
+            now = time_millis()
+            for path, entry in self.entries.items():
+                if entry.pins == 0 and entry.expires is not None and entry.expires < now:
+                    victims.append(path)
+            for path in victims:
+                self.size -= self.entries.pop(path).size
+            self.dirty = self.dirty or len(victims) > 0
+            if CACHE_OWNER and self.size > CACHE_BUDGET_BYTES:
+                candidates = [(path, entry) for path, entry in self.entries.items() if entry.pins == 0]
+                if CACHE_EVICTION_POLICY == 'lfu':
+                    candidates.sort(key=lambda candidate: (candidate[1].hits, candidate[1].last_access))
+                else:
+                    candidates.sort(key=lambda candidate: candidate[1].last_access)
+                for path, entry in candidates:
+                    if self.size <= CACHE_BUDGET_BYTES:
+                        break
+                    self.size -= entry.size
+                    del self.entries[path]
+                    victims.append(path)
+                    self.dirty = True
+        for path in victims:
+            print('CLEANING ' + path)
+            try:
+                os.remove(path)
+            except:
+                pass
+        if victims:
+            counter_cache_evictions.add(len(victims))
+
+    def sweep(self):
+        # removes stray files that never made it into the index (like leftovers of failed downloads or temporary files of other workers)
+        if not CACHE_OWNER:
+            return
+        if VOICE_WORKER is not None:
+            self.refresh()
+        with self.lock:
+            known = set(self.entries.keys())
+        for entry in os.scandir(STORAGE_DIRECTORY):
+            if entry.is_file() and not entry.name.startswith('.') and entry.path not in known and entry.stat().st_mtime * 1000 + CACHE_TEMPORARY_MAX_AGE < time_millis():
+                print('CLEANING ' + entry.path)
+                try:
+                    os.remove(entry.path)
+                except:
+                    pass
+
+    def get_size(self):
+        with self.lock:
+            return self.size
+
+    def get_count(self):
+        with self.lock:
+            return len(self.entries)
+
+def is_cache_file(name):
+    return name.startswith('audio.out.') and name.endswith('.' + PACKET_FILE_EXTENSION)
+
+def touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+CACHE_INDEX_FILE = STORAGE_DIRECTORY + '/.index.json'
+
+cache_index = CacheIndex()
+
+def get_cache_size(options):
+    yield metrics.Observation(cache_index.get_size())
+
+def get_cache_count(options):
+    yield metrics.Observation(cache_index.get_count())
+
+meter.create_observable_gauge('discord.gateway.voice.cache.size', [get_cache_size], unit="bytes")
+meter.create_observable_gauge('discord.gateway.voice.cache.files', [get_cache_count], unit="count")
+
+class TokenBucket:
+    # shared by all downloads, a download that runs out of tokens sleeps until enough have been refilled
+    lock = None
+    rate = 0
+    tokens = 0
+    last = 0
+
+    def __init__(self, rate):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    def consume(self, amount):
+        if self.rate <= 0:
+            return
+        delay = 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            if self.tokens < 0:
+                delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+histogram_download_time_to_ready = meter.create_histogram(name = 'discord.gateway.voice.downloads.time_to_ready', description = 'Time from requesting a track until it is ready to be played, including waiting for a download slot', unit="milliseconds")
+counter_download_deduplications = meter.create_counter(name = 'discord.gateway.voice.downloads.deduplicated', description = 'Number of track requests that joined a download already in progress', unit="count")
+
+class DownloadLock:
+    # serializes the downloads of one cache key across the worker processes sharing the cache directory (within a process, the flights do that already)
+    # the keys are striped over a fixed set of lock files, so they never need to be cleaned up
+    path = None
+    file = None
+
+    def __init__(self, key):
+        self.path = STORAGE_DIRECTORY + '/.download.' + str(int(hashlib.sha256(key.encode('utf-8')).hexdigest(), 16) % DOWNLOAD_LOCK_STRIPES) + '.lock'
+
+    def acquire(self):
+        if VOICE_WORKER is None:
+            return # the only process using the cache
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def release(self):
+        if self.file:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+class DownloadManager:
+    # runs at most one download per cache key (all other requests for the same key share its future) and at most MAX_CONCURRENT_DOWNLOADS at once
+    lock = None
+    slots = None
+    flights = None
+    waiting = 0
+    active = 0
+    bandwidth = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+        self.flights = {}
+        self.bandwidth = TokenBucket(DOWNLOAD_BANDWIDTH_LIMIT)
+
+    def join(self, key):
+        # returns the future of the flight for the key, and whether it was just opened (then the caller must finish it)
+        with self.lock:
+            future = self.flights.get(key)
+            if future:
+                counter_download_deduplications.add(1)
+                return future, False
+            future = self.flights[key] = concurrent.futures.Future()
+            return future, True
+
+    def finish(self, key, future, result = None, exception = None):
+        with self.lock:
+            self.flights.pop(key, None)
+        if exception:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def fetch(self, key, download):
+        start = time_millis()
+        future, leader = self.join(key)
+        if not leader:
+            return future.result()
+        result = None
+        exception = None
+        try:
+            self.acquire()
+            lock = DownloadLock(key)
+            try:
+                lock.acquire()
+                result = download()
+            finally:
+                lock.release()
+                self.release()
+        except BaseException as e:
+            exception = e
+        finally:
+            self.finish(key, future, result, exception)
+            histogram_download_time_to_ready.record(time_millis() - start)
+        return future.result()
+
+    def acquire(self):
+        # waits for one of the MAX_CONCURRENT_DOWNLOADS slots
+        with self.lock:
+            self.waiting += 1
+        try:
+            self.slots.acquire()
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        with self.lock:
+            self.active += 1
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+        self.slots.release()
+
+    def get_ratelimit(self):
+        # yt_dlp limits each download on its own, so the budget is split evenly
+        return DOWNLOAD_BANDWIDTH_LIMIT // MAX_CONCURRENT_DOWNLOADS if DOWNLOAD_BANDWIDTH_LIMIT > 0 else None
+
+    def throttle(self, amount):
+        self.bandwidth.consume(amount)
+
+    def get_waiting(self):
+        with self.lock:
+            return self.waiting
+
+    def get_active(self):
+        with self.lock:
+            return self.active
+
+download_manager = DownloadManager()
+
+def get_download_queue_depth(options):
+    yield metrics.Observation(download_manager.get_waiting())
+
+def get_download_active(options):
+    yield metrics.Observation(download_manager.get_active())
+
+meter.create_observable_gauge('discord.gateway.voice.downloads.queued', [get_download_queue_depth])
+meter.create_observable_gauge('discord.gateway.voice.downloads.active', [get_download_active])
 
 def download_from_youtube(url, filename_prefix):
     path = STORAGE_DIRECTORY + '/' + filename_prefix
@@ -216,75 +821,166 @@ def download_from_youtube(url, filename_prefix):
         'nooverwrites': False,
         'updatetime': False
     }
+    if download_manager.get_ratelimit():
+        options['ratelimit'] = download_manager.get_ratelimit()
     with yt_dlp.YoutubeDL(options) as ydl:
         ydl.download([url])
-        return next(((os.path.join(STORAGE_DIRECTORY, file)) for file in os.listdir(STORAGE_DIRECTORY) if file.startswith(filename_prefix)), None)
+        return next(((os.path.join(STORAGE_DIRECTORY, file)) for file in os.listdir(STORAGE_DIRECTORY) if file.startswith(filename_prefix) and not file.endswith('.part') and not file.endswith('.' + PACKET_FILE_EXTENSION)), None)
 
-def download_url(url, filename_prefix):
-    response = requests.get(url)
-    if response.status_code != 200:
-        raise RuntimeError
-    codec = None
-    content_type = response.headers['content-type']
+download_session = requests.Session()
+
+def get_download_codec(url, response):
+    content_type = response.headers.get('content-type', '')
     if content_type.startswith('audio/') or content_type.startswith('video/'):
-        codec = content_type.split('/', 1)[1]
-    else:
-        codec = url.rsplit('.', 1)[1]
-        if len(codec) > 5 or '/' in codec or '.' in codec:
-            raise RuntimeError
-    path = STORAGE_DIRECTORY + '/' + filename_prefix + '.' + codec
-    if not os.path.normpath(path).startswith(STORAGE_DIRECTORY):
+        return content_type.split('/', 1)[1].split(';', 1)[0].strip()
+    codec = url.rsplit('.', 1)[1]
+    if len(codec) > 5 or '/' in codec or '.' in codec:
         raise RuntimeError
-    with open(path, 'wb') as file:
-        file.write(response.content)
-    return path
+    return codec
+
+def get_download_validators(response):
+    validators = {}
+    if response.headers.get('etag'):
+        validators['etag'] = response.headers['etag']
+    if response.headers.get('last-modified'):
+        validators['last_modified'] = response.headers['last-modified']
+    return validators
+
+def download_url(url, filename_prefix):
+    # streams to a temporary file and resumes interrupted transfers with range requests (guarded by If-Range, so a changed file starts over)
+    path = None
+    validators = {}
+    offset = 0
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes=' + str(offset) + '-'
+            if validators.get('etag') or validators.get('last_modified'):
+                headers['If-Range'] = validators.get('etag') or validators.get('last_modified')
+        try:
+            with download_session.get(url, headers = headers, stream = True, timeout = DOWNLOAD_TIMEOUT) as response:
+                if response.status_code == 200:
+                    offset = 0
+                elif response.status_code != 206 or offset == 0:
+                    raise RuntimeError('HTTP ' + str(response.status_code))
+                if not path:
+                    path = STORAGE_DIRECTORY + '/' + filename_prefix + '.' + get_download_codec(url, response)
+                    if not os.path.normpath(path).startswith(STORAGE_DIRECTORY):
+                        raise RuntimeError
+                if response.status_code == 200:
+                    validators = get_download_validators(response)
+                length = response.headers.get('content-length')
+                if length and offset + int(length) > DOWNLOAD_MAX_SIZE:
+                    raise RuntimeError('file too large')
+                with open(path + '.part', 'ab' if offset > 0 else 'wb') as file:
+                    for chunk in response.iter_content(chunk_size = 64 * 1024):
+                        offset += len(chunk)
+                        if offset > DOWNLOAD_MAX_SIZE:
+                            raise RuntimeError('file too large')
+                        download_manager.throttle(len(chunk))
+                        file.write(chunk)
+            os.replace(path + '.part', path)
+            validators['validated'] = time_millis()
+            return path, validators
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt < DOWNLOAD_RETRIES:
+                print('VOICE download of ' + url + ' interrupted after ' + str(offset) + ' bytes, resuming (' + str(e) + ')')
+                continue
+            if path and os.path.exists(path + '.part'):
+                os.remove(path + '.part')
+            raise
+        except Exception:
+            if path and os.path.exists(path + '.part'):
+                os.remove(path + '.part')
+            raise
+
+def revalidate_url(url, path):
+    # asks the origin whether a cached track is still current, the cached track wins whenever the origin cannot tell
+    metadata = cache_index.get_metadata(path)
+    if not metadata or not (metadata.get('etag') or metadata.get('last_modified')):
+        return True
+    if metadata.get('validated', 0) + DOWNLOAD_REVALIDATE_INTERVAL > time_millis():
+        return True
+    headers = {}
+    if metadata.get('etag'):
+        headers['If-None-Match'] = metadata['etag']
+    if metadata.get('last_modified'):
+        headers['If-Modified-Since'] = metadata['last_modified']
+    try:
+        with download_session.get(url, headers = headers, stream = True, timeout = DOWNLOAD_TIMEOUT) as response:
+            status = response.status_code
+            validators = get_download_validators(response)
+    except requests.exceptions.RequestException:
+        return True
+    if status == 200 and validators and validators.get('etag', metadata.get('etag')) == metadata.get('etag') and validators.get('last_modified', metadata.get('last_modified')) == metadata.get('last_modified'):
+        status = 304
+    if status != 200:
+        metadata['validated'] = time_millis()
+        cache_index.add(path, metadata = metadata)
+        return True
+    print('VOICE cached ' + path + ' is outdated')
+    cache_index.remove(path)
+    return False
+
+def normalize_url(url):
+    # maps all the different urls of the same track to one identity, so the same track is only downloaded and encoded once across all guilds
+    parsed = urllib.parse.urlsplit(url.strip())
+    host = parsed.netloc.lower()
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    if host.startswith('m.'):
+        host = host[len('m.'):]
+    video_id = None
+    if host in ['youtube.com', 'music.youtube.com'] and parsed.path == '/watch':
+        video_id = urllib.parse.parse_qs(parsed.query).get('v', [None])[0]
+    elif host in ['youtube.com', 'music.youtube.com'] and parsed.path.startswith('/shorts/'):
+        video_id = parsed.path[len('/shorts/'):]
+    elif host == 'youtu.be':
+        video_id = parsed.path[1:]
+    if video_id:
+        return 'youtube:' + video_id
+    return urllib.parse.urlunsplit((parsed.scheme.lower(), parsed.netloc.lower(), parsed.path, parsed.query, ''))
+
+def get_cache_key(url):
+    return hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()[:32]
+
+def get_cache_filename_prefix(url):
+    return 'audio.out.' + get_cache_key(url)
 
 def resolve_url(guild_id, url):
-    if '/' in guild_id or '.' in guild_id:
-        raise RuntimeError
-    codec = 'mp3'
-    filename_prefix = 'audio.out.' + guild_id + '.' + str(hash(url))
+    codec = PACKET_FILE_EXTENSION # the cache holds tracks in the format the streamer plays
+    filename_prefix = get_cache_filename_prefix(url)
     path = STORAGE_DIRECTORY + '/' + filename_prefix + '.' + codec
     if not os.path.normpath(path).startswith(STORAGE_DIRECTORY):
         raise RuntimeError
-    if os.path.exists(path):
-        os.utime(path)
+    if cache_index.lookup(path) and revalidate_url(url, path):
+        counter_packet_file_hits.add(1)
         return path
 
-    event = None
-    download_in_progress = False
-    with download_lock:
-        download_in_progress = downloads.get(url) and not downloads[url].is_set()
-        if not downloads.get(url):
-            downloads[url] = threading.Event()
-        event = downloads[url]
-    if download_in_progress:
-        event.wait()
-        return resolve_url(guild_id, url)
-    
+    return download_manager.fetch(filename_prefix, lambda: download_track(url, filename_prefix, path))
+
+def download_track(url, filename_prefix, path):
+    if os.path.exists(path):
+        return path # finished by another flight between the cache lookup and this one
+    metadata = { 'url': normalize_url(url) }
+    if url.startswith('https://www.youtube.com/watch?v=') or url.startswith('https://youtu.be/'):
+        source_path = download_from_youtube(url, filename_prefix)
+    elif url.startswith('http://') or url.startswith('https://'):
+        source_path, validators = download_url(url, filename_prefix)
+        metadata.update(validators)
+    elif url.startswith('file://'):
+        source_path = STORAGE_DIRECTORY + '/' + filename_prefix + '.' + url.rsplit('.', 1)[1]
+        if not os.path.normpath(source_path).startswith(STORAGE_DIRECTORY):
+            raise RuntimeError
+        os.rename(url[len('file://'):], source_path)
+    else:
+        raise RuntimeError(url)
     try:
-        if url.startswith('https://www.youtube.com/watch?v=') or url.startswith('https://youtu.be/'):
-            path = download_from_youtube(url, filename_prefix)
-        elif url.startswith('http://') or url.startswith('https://'):
-            path = download_url(url, filename_prefix)
-        elif url.startswith('file://'):
-            path = STORAGE_DIRECTORY + '/' + filename_prefix + '.' + url.rsplit('.', 1)[1]
-            if not os.path.normpath(path).startswith(STORAGE_DIRECTORY):
-                raise RuntimeError
-            os.rename(url[len('file://'):], path)
-        else:
-            raise RuntimeError(url)
-        os.utime(path)
+        convert_to_packet_file(source_path, path, metadata = metadata)
     finally:
-        with download_lock:
-            downloads[event] = None
-        event.set()
-
-    if not path.endswith('.' + codec): # to optimize for space, not functionally necessary
-        old_path = path
-        path = old_path.rsplit('.', 1)[0] + '.' + codec
-        observed_subprocess_run(['ffmpeg', '-i', old_path, '-f', codec, '-y', path]).check_returncode()
-        os.remove(old_path)
+        os.remove(source_path)
+    if url.startswith('file://'):
+        cache_index.add(path, CACHE_TEMPORARY_MAX_AGE) # uploads are played once
     return path
 
 frame_duration = 20
@@ -296,43 +992,946 @@ desired_frame_size = int(frame_rate * frame_duration / 1000)
 counter_streams = meter.create_counter(name = 'discord.gateway.voice.streams', description = 'Number of streams', unit="count")
 counter_streaming = meter.create_counter(name = 'discord.gateway.voice.streaming', description = 'Amount of time streamed', unit="milliseconds")
 counter_real_time_violations = meter.create_counter(name = 'discord.gateway.voice.real_time_violations', description = 'Time audio has not been sent in real-time', unit="milliseconds")
+histogram_frame_lateness = meter.create_histogram(name = 'discord.gateway.voice.frame_lateness', description = 'Time a frame has been sent after its deadline', unit="milliseconds")
+histogram_tick_duration = meter.create_histogram(name = 'discord.gateway.voice.tick.duration', description = 'Time to prepare and send the frames of all connections in one tick', unit="milliseconds")
+histogram_tick_connections = meter.create_histogram(name = 'discord.gateway.voice.tick.connections', description = 'Number of connections a frame has been sent for in one tick', unit="count")
+histogram_tick_utilization = meter.create_histogram(name = 'discord.gateway.voice.tick.utilization', description = 'Share of the frame duration used to prepare and send the frames of all connections in one tick', unit="percent")
+counter_tick_overruns = meter.create_counter(name = 'discord.gateway.voice.tick.overruns', description = 'Number of ticks that took longer than the frame duration', unit="count")
+counter_skipped_frames = meter.create_counter(name = 'discord.gateway.voice.skipped_frames', description = 'Number of frame deadlines skipped after a stall', unit="count")
+counter_packet_files = meter.create_counter(name = 'discord.gateway.voice.packet_files', description = 'Number of tracks encoded into packet files', unit="count")
+counter_packet_file_hits = meter.create_counter(name = 'discord.gateway.voice.packet_files.hits', description = 'Number of tracks served from already encoded packet files', unit="count")
+
+class FrameScheduler:
+    # every frame has an absolute deadline derived from its number, so sleeping imprecisely never accumulates into drift
+    interval = frame_duration * 1000000
+    start = None
+    frame = 0
+    max_catch_up = None
+
+    def __init__(self, max_catch_up = FRAME_SCHEDULER_MAX_CATCH_UP):
+        self.max_catch_up = max_catch_up
+        self.start = time.monotonic_ns()
+
+    def deadline(self):
+        return self.start + self.frame * self.interval
+
+    def next(self):
+        # returns how long (in nanoseconds) to wait for the next frame, how late it is, and how many deadlines have been skipped to get back to real-time
+        self.frame += 1
+        now = time.monotonic_ns()
+        delay = self.deadline() - now
+        if delay > 0:
+            return delay, 0, 0
+        lateness = -delay
+        if lateness <= self.max_catch_up * self.interval:
+            return 0, lateness, 0 # send right away to catch up
+        # we stalled for too long, catching up would mean bursting a lot of frames, so lets continue from now instead
+        skipped = lateness // self.interval
+        self.start += skipped * self.interval
+        return 0, lateness - skipped * self.interval, skipped
+
+    def wait(self):
+        delay, lateness, skipped = self.next()
+        if delay > 0:
+            time.sleep(delay / 1000000000)
+        return lateness, skipped
+
+# packet files contain pre-encoded opus frames so that streaming does not need to encode every frame for every guild
+# layout: magic, frames (2 byte length + opus frame), index (4 byte offset per frame), footer (4 byte frame count, 4 byte index offset, magic)
+PACKET_FILE_MAGIC = b'PHBOPUS1'
+PACKET_FILE_EXTENSION = 'packets'
+PACKET_FILE_FOOTER_SIZE = 4 + 4 + len(PACKET_FILE_MAGIC)
+
+class PacketFileWriter:
+    file = None
+    offsets = None
 
-class Packet:
-    sequence = None
-    timestamp = None
-    pcm = None
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(PACKET_FILE_MAGIC)
+        self.offsets = []
 
-    def __init__(self, sequence, timestamp, pcm):
-        self.sequence = sequence
-        self.timestamp = timestamp
-        self.time = time
-        self.pcm = pcm
+    def write(self, opus_frame):
+        self.offsets.append(self.file.tell())
+        self.file.write(struct.pack('>H', len(opus_frame)))
+        self.file.write(opus_frame)
 
-    def get_sequence(self):
-        return self.sequence
-    
-    def get_timestamp(self):
-        return self.timestamp
-    
-    def get_pcm(self):
-        return self.pcm
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        index_offset = self.file.tell()
+        self.file.write(struct.pack('>' + str(len(self.offsets)) + 'I', *self.offsets))
+        self.file.write(struct.pack('>II', len(self.offsets), index_offset))
+        self.file.write(PACKET_FILE_MAGIC)
+        self.file.close()
+
+class PacketFileReader:
+    file = None
+    frame_count = None
+    index_offset = None
+    frame = None
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        try:
+            if self.file.read(len(PACKET_FILE_MAGIC)) != PACKET_FILE_MAGIC:
+                raise RuntimeError('invalid packet file: ' + path)
+            self.file.seek(-PACKET_FILE_FOOTER_SIZE, os.SEEK_END)
+            footer = self.file.read(PACKET_FILE_FOOTER_SIZE)
+            if footer[8:] != PACKET_FILE_MAGIC:
+                raise RuntimeError('incomplete packet file: ' + path)
+            self.frame_count, self.index_offset = struct.unpack_from('>II', footer, 0)
+            self.file.seek(len(PACKET_FILE_MAGIC))
+            self.frame = 0
+        except:
+            self.file.close()
+            raise
+
+    def get_frame_count(self):
+        return self.frame_count
+
+    def get_duration_secs(self):
+        return self.frame_count * frame_duration / 1000
+
+    def get_position_secs(self):
+        return self.frame * frame_duration / 1000
+
+    def seek(self, frame):
+        # one lookup in the index, the next read continues at the given frame, returns False (and stays where it is) if the frame is past the end
+        if frame > self.frame_count:
+            return False
+        self.frame = max(0, frame)
+        if self.frame == self.frame_count:
+            self.file.seek(self.index_offset)
+        else:
+            self.file.seek(self.index_offset + self.frame * 4)
+            self.file.seek(struct.unpack('>I', self.file.read(4))[0])
+        return True
+
+    def read(self):
+        if self.frame >= self.frame_count:
+            return None
+        length = struct.unpack('>H', self.file.read(2))[0]
+        self.frame += 1
+        return self.file.read(length)
+
+    def close(self):
+        self.file.close()
+
+class PacketEncoder:
+    encoder = None
+    buffer = None
+    padded = None
+
+    def __init__(self):
+        error = ctypes.c_int(0)
+        self.encoder = pyogg.opus.opus_encoder_create(pyogg.opus.opus_int32(frame_rate), ctypes.c_int(channels), ctypes.c_int(pyogg.opus.OPUS_APPLICATION_AUDIO), ctypes.byref(error))
+        if error.value != 0:
+            raise RuntimeError(str(error.value))
+        self.buffer = ctypes.create_string_buffer(desired_frame_size * channels * sample_width)
+        self.padded = ctypes.create_string_buffer(desired_frame_size * channels * sample_width)
+
+    def encode(self, pcm):
+        return self.encode_batch(pcm)[0]
+
+    def encode_batch(self, pcm):
+        # encodes consecutive frames straight out of one buffer, without slicing the input per frame, a short last frame is padded with silence in a reused buffer
+        frame_bytes = desired_frame_size * channels * sample_width
+        address = ctypes.cast(pcm, ctypes.c_void_p).value
+        frames = []
+        for offset in range(0, len(pcm), frame_bytes):
+            source = address + offset
+            if len(pcm) - offset < frame_bytes:
+                ctypes.memset(self.padded, 0, frame_bytes)
+                ctypes.memmove(self.padded, source, len(pcm) - offset)
+                source = ctypes.addressof(self.padded)
+            encoded_bytes = pyogg.opus.opus_encode(self.encoder, ctypes.cast(source, pyogg.opus.opus_int16_p), ctypes.c_int(desired_frame_size), ctypes.cast(self.buffer, pyogg.opus.c_uchar_p), pyogg.opus.opus_int32(len(self.buffer)))
+            if encoded_bytes < 0:
+                raise RuntimeError(str(encoded_bytes))
+            frames.append(ctypes.string_at(self.buffer, encoded_bytes))
+        return frames
+
+    def close(self):
+        pyogg.opus.opus_encoder_destroy(self.encoder)
+
+def convert_to_packet_file(source, packet_path, headers = None, on_progress = None, metadata = None):
+    # single pass from the original container straight to the cache format, ffmpeg only decodes and resamples to raw pcm which is encoded to opus in-process
+    encoder = PacketEncoder()
+    writer = PacketFileWriter(packet_path + '.part')
+    frame_bytes = desired_frame_size * channels * sample_width
+    def consume(stdout):
+        while True:
+            # progressive playback publishes every frame right away, otherwise whole batches are read and encoded at once
+            pcm = stdout.read(frame_bytes if on_progress else frame_bytes * CONVERSION_BATCH_FRAMES)
+            if not pcm:
+                break
+            for opus_frame in encoder.encode_batch(pcm):
+                writer.write(opus_frame)
+            if on_progress:
+                writer.flush()
+                on_progress(writer.offsets)
+    command = ['ffmpeg']
+    if headers:
+        command += ['-headers', ''.join(key + ': ' + value + '\r\n' for key, value in headers.items())]
+    if source.startswith('http://') or source.startswith('https://'):
+        command += ['-reconnect', '1', '-reconnect_streamed', '1']
+    command += ['-i', source, '-f', 's' + str(sample_width * 8) + 'le', '-ar', str(frame_rate), '-ac', str(channels), 'pipe:1']
+    returncode = None
+    try:
+        returncode = observed_subprocess_stream(command, consume)
+    finally:
+        writer.close()
+        encoder.close()
+        if returncode == 0:
+            os.rename(packet_path + '.part', packet_path)
+            cache_index.add(packet_path, metadata = metadata)
+        elif os.path.exists(packet_path + '.part'):
+            os.remove(packet_path + '.part')
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    counter_packet_files.add(1)
+
+class ProgressiveTrack:
+    # decodes a remote source while it is still downloading, the conversion never waits for anybody,
+    # all readers tail the growing packet file (at their own pace) until it lands in the cache
+    key = None
+    future = None
+    path = None
+    source = None
+    headers = None
+    metadata = None
+    lock = None
+    condition = None
+    offsets = None
+    frames = 0
+    finished = False
+    created = None
+    ready = False
+
+    def __init__(self, key, future, path, lock, created, metadata = None):
+        # takes over the download slot and the lock of the flight, both are released when it finishes
+        self.key = key
+        self.future = future
+        self.path = path
+        self.lock = lock
+        self.metadata = metadata
+        self.condition = threading.Condition()
+        self.offsets = []
+        self.created = created
+
+    def start(self, source, headers):
+        self.source = source
+        self.headers = headers
+        threading.Thread(target=self.__run).start()
+
+    def __run(self):
+        exception = None
+        try:
+            convert_to_packet_file(self.source, self.path, self.headers, self.__progress, self.metadata)
+        except Exception as e:
+            print('VOICE progressive download of ' + self.path + ' failed: ' + str(e))
+            exception = e
+        finally:
+            self.finish(exception)
+
+    def finish(self, exception = None):
+        with progressive_tracks_lock:
+            progressive_tracks.pop(self.path, None)
+        with self.condition:
+            self.finished = True
+        self.lock.release()
+        download_manager.release()
+        self.__ready()
+        download_manager.finish(self.key, self.future, self.path if not exception else None, exception)
+
+    def __ready(self):
+        # the time to ready of a progressive track is the time until its first frame can be played (or until it failed)
+        with self.condition:
+            if self.ready:
+                return
+            self.ready = True
+        histogram_download_time_to_ready.record(time_millis() - self.created)
+
+    def __progress(self, offsets):
+        # the frames are flushed to the file already, so readers may read up to here
+        with self.condition:
+            self.offsets = offsets
+            self.frames = len(offsets)
+        if offsets:
+            self.__ready()
+
+    def get_progress(self):
+        with self.condition:
+            return self.frames, self.finished
+
+    def get_offset(self, frame):
+        with self.condition:
+            return self.offsets[frame]
+
+    def open_reader(self):
+        return ProgressiveTrackReader(self)
+
+class ProgressiveTrackReader:
+    track = None
+    file = None
+    frame = 0
+    started = False
+    seeked = True
+
+    def __init__(self, track):
+        self.track = track
+
+    def get_duration_secs(self):
+        frames, finished = self.track.get_progress()
+        return frames * frame_duration / 1000 if finished else None
+
+    def get_position_secs(self):
+        return self.frame * frame_duration / 1000
+
+    def seek(self, frame):
+        # only within what has been converted so far, returns False (and stays where it is) otherwise
+        frames, finished = self.track.get_progress()
+        if frame > frames:
+            return False
+        self.frame = max(0, frame)
+        self.seeked = True
+        return True
+
+    def read(self):
+        frames, finished = self.track.get_progress()
+        if not self.started:
+            if frames - self.frame < PROGRESSIVE_PREBUFFER_FRAMES and not finished:
+                return b''
+            self.started = True
+        if self.frame >= frames:
+            return None if finished else b'' # caught up with the conversion
+        if not self.file:
+            try:
+                self.file = open(self.track.path + '.part', 'rb')
+            except FileNotFoundError:
+                try:
+                    self.file = open(self.track.path, 'rb') # completed in the meantime
+                except FileNotFoundError:
+                    return None # failed in the meantime
+        if self.seeked:
+            self.file.seek(self.track.get_offset(self.frame))
+            self.seeked = False
+        length = struct.unpack('>H', self.file.read(2))[0]
+        self.frame += 1
+        return self.file.read(length)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+progressive_tracks_lock = threading.Lock()
+progressive_tracks = {}
+
+def resolve_url_progressive(guild_id, url):
+    filename_prefix = get_cache_filename_prefix(url)
+    path = STORAGE_DIRECTORY + '/' + filename_prefix + '.' + PACKET_FILE_EXTENSION
+    if not os.path.normpath(path).startswith(STORAGE_DIRECTORY):
+        raise RuntimeError
+    if cache_index.lookup(path) and revalidate_url(url, path):
+        counter_packet_file_hits.add(1)
+        return path
+    # progressive tracks share the flights of the download manager, so there is only ever one writer per cache file
+    start = time_millis()
+    future, leader = download_manager.join(filename_prefix)
+    if not leader:
+        with progressive_tracks_lock:
+            if progressive_tracks.get(path):
+                return path # can be played while it is being converted
+        return future.result() # a regular download, wait for it
+    # counts against MAX_CONCURRENT_DOWNLOADS like every download, and another worker converting the same track cannot be tailed from here, so wait for it to land in the cache
+    lock = DownloadLock(filename_prefix)
+    try:
+        download_manager.acquire()
+        try:
+            lock.acquire()
+        except BaseException:
+            download_manager.release()
+            raise
+    except BaseException as e:
+        download_manager.finish(filename_prefix, future, exception=e)
+        raise
+    if os.path.exists(path):
+        lock.release()
+        download_manager.release()
+        download_manager.finish(filename_prefix, future, path) # finished by another flight between the cache lookup and this one
+        return path
+    # registered right away, so other guilds can start tailing it while the source is still being looked up
+    track = ProgressiveTrack(filename_prefix, future, path, lock, start, { 'url': normalize_url(url) })
+    with progressive_tracks_lock:
+        progressive_tracks[path] = track
+    try:
+        headers = None
+        if url.startswith('https://www.youtube.com/watch?v=') or url.startswith('https://youtu.be/'):
+            with yt_dlp.YoutubeDL({ 'quiet': True, 'no_warnings': True, 'geo_bypass': True, 'format': 'bestaudio' }) as ydl:
+                info = ydl.extract_info(url, download=False)
+                source = info['url']
+                headers = info.get('http_headers')
+        elif url.startswith('http://') or url.startswith('https://'):
+            source = url
+        else:
+            raise RuntimeError(url)
+    except BaseException as e:
+        track.finish(e)
+        raise
+    track.start(source, headers)
+    return path
+
+def open_packet_source(path):
+    track = None
+    with progressive_tracks_lock:
+        track = progressive_tracks.get(path)
+    if track:
+        return track.open_reader()
+    if not os.path.exists(path):
+        return None
+    return PacketFileReader(path)
+
+counter_prefetches = meter.create_counter(name = 'discord.gateway.voice.prefetches', description = 'Number of prefetched tracks', unit="count")
+histogram_prefetch_wait = meter.create_histogram(name = 'discord.gateway.voice.prefetch.wait', description = 'Time a prefetch has been queued before it started', unit="milliseconds")
+
+class PrefetchJob:
+    __slots__ = ('key', 'guild_id', 'url', 'path', 'priority', 'status', 'error', 'created', 'updated')
+
+    def __init__(self, key, guild_id, url, priority):
+        self.key = key
+        self.guild_id = guild_id
+        self.url = url
+        self.path = STORAGE_DIRECTORY + '/' + get_cache_filename_prefix(url) + '.' + PACKET_FILE_EXTENSION
+        self.priority = priority
+        self.status = 'queued'
+        self.error = None
+        self.created = time_millis()
+        self.updated = self.created
+
+class PrefetchScheduler:
+    # resolves upcoming tracks in the background with a fixed number of workers, lower priority values first,
+    # and holds back new prefetches while tracks are resolved for playback
+    condition = None
+    queue = None
+    jobs = None
+    counter = 0
+    foreground = 0
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queue = []
+        self.jobs = {}
+        for _ in range(PREFETCH_WORKERS):
+            threading.Thread(target=self.__run).start()
+
+    def submit(self, guild_id, url, priority = 0):
+        key = get_cache_key(url)
+        with self.condition:
+            self.__prune()
+            job = self.jobs.get(key)
+            if job and job.status != 'failed' and not self.__is_gone(job):
+                if job.status == 'queued' and priority < job.priority:
+                    job.priority = priority
+                    self.counter += 1
+                    heapq.heappush(self.queue, (job.priority, self.counter, key))
+                return job
+            if len(self.queue) >= PREFETCH_QUEUE_SIZE:
+                raise RuntimeError('prefetch queue is full')
+            job = self.jobs[key] = PrefetchJob(key, guild_id, url, priority)
+            self.counter += 1
+            heapq.heappush(self.queue, (job.priority, self.counter, key))
+            self.condition.notify()
+            return job
+
+    def get(self, url):
+        with self.condition:
+            key = get_cache_key(url)
+            job = self.jobs.get(key)
+            if job and self.__is_gone(job):
+                del self.jobs[key]
+                return None
+            return job
+
+    def get_depth(self):
+        with self.condition:
+            return sum(1 for job in self.jobs.values() if job.status == 'queued')
+
+    def preempt(self, url):
+        # called when a track is needed for playback right now, it is resolved in the request itself and prefetches wait until it is done
+        with self.condition:
+            self.foreground += 1
+            job = self.jobs.get(get_cache_key(url))
+            if job and job.status == 'queued':
+                job.status = 'downloading'
+                job.updated = time_millis()
+            return job
+
+    def release(self, job, error = None):
+        with self.condition:
+            self.foreground -= 1
+            if job and job.status == 'downloading':
+                self.__finish(job, error)
+            self.condition.notify_all()
+
+    def __prune(self):
+        now = time_millis()
+        for key in [key for key, job in self.jobs.items() if job.status in ['ready', 'failed'] and job.updated + PREFETCH_STATUS_MAX_AGE < now]:
+            del self.jobs[key]
+
+    def __is_gone(self, job):
+        # a ready track may have been evicted from the cache since, then it has to be prefetched again
+        return job.status == 'ready' and not os.path.exists(job.path)
+
+    def __finish(self, job, error):
+        job.status = 'failed' if error else 'ready'
+        job.error = error
+        job.updated = time_millis()
+        counter_prefetches.add(1, { 'status': job.status })
+
+    def __take(self):
+        with self.condition:
+            while True:
+                while self.queue and (not self.jobs.get(self.queue[0][2]) or self.jobs[self.queue[0][2]].status != 'queued' or self.jobs[self.queue[0][2]].priority != self.queue[0][0]):
+                    heapq.heappop(self.queue) # outdated entry (finished by playback or re-prioritized)
+                if self.queue and self.foreground == 0:
+                    break
+                self.condition.wait()
+            priority, counter, key = heapq.heappop(self.queue)
+            job = self.jobs[key]
+            job.status = 'downloading'
+            job.updated = time_millis()
+            return job
+
+    def __run(self):
+        while True:
+            job = self.__take()
+            histogram_prefetch_wait.record(job.updated - job.created)
+            error = None
+            try:
+                resolve_url(job.guild_id, job.url)
+            except yt_dlp.utils.DownloadError as e:
+                error = describe_download_error(e)[0]
+            except Exception as e:
+                error = str(e)
+            if error:
+                print('VOICE prefetch of ' + job.url + ' failed: ' + error)
+            with self.condition:
+                if job.status == 'downloading':
+                    self.__finish(job, error)
+
+prefetch_scheduler = None
+
+def get_prefetch_queue_depth(options):
+    yield metrics.Observation(prefetch_scheduler.get_depth() if prefetch_scheduler else 0)
+
+meter.create_observable_gauge('discord.gateway.voice.prefetches.queued', [get_prefetch_queue_depth])
+
+def describe_download_error(e):
+    if 'Private video' in str(e):
+        return 'Private video', 403
+    elif 'blocked' in str(e) or 'copyright' in str(e) or "in your country" in str(e):
+        return 'Blocked video', 451
+    elif 'inappropriate' in str(e) or 'confirm your age' in str(e):
+        return 'Age-restricted video', 451
+    elif 'account' in str(e) and 'terminated' in str(e):
+        return 'Video not found', 404
+    else:
+        return 'Video not found', 404
+
+counter_jitter_buffer_drops = meter.create_counter(name = 'discord.gateway.voice.jitter_buffer.drops', description = 'Number of received packets dropped because they arrived too late or too far ahead', unit="count")
+
+class JitterBufferSlot:
+    __slots__ = ('sequence', 'timestamp', 'payload')
+
+    def __init__(self):
+        self.sequence = None
+        self.timestamp = None
+        self.payload = None
+
+class JitterBuffer:
+    # fixed-size ring indexed by sequence modulo capacity, sequences are 16 bit and wrap around
+    __slots__ = ('slots', 'mask', 'next_sequence', 'span', 'count', 'dropped', 'started')
+
+    def __init__(self, capacity):
+        if capacity & (capacity - 1) != 0:
+            raise RuntimeError('capacity must be a power of two')
+        self.slots = [JitterBufferSlot() for _ in range(capacity)]
+        self.mask = capacity - 1
+        self.next_sequence = None
+        self.span = 0 # distance from next_sequence to the newest packet (exclusive)
+        self.count = 0
+        self.dropped = 0
+        self.started = False
+
+    def __len__(self):
+        return self.count
+
+    def insert(self, sequence, timestamp, payload):
+        if self.next_sequence is None:
+            self.next_sequence = sequence
+        distance = (sequence - self.next_sequence) & 0xFFFF
+        if distance >= 0x8000 and not self.started and ((self.next_sequence - sequence) & 0xFFFF) + self.span <= self.mask:
+            # nothing has been played out yet, so an earlier packet arriving late just moves the start
+            self.span += (self.next_sequence - sequence) & 0xFFFF
+            self.next_sequence = sequence
+            distance = 0
+        if distance >= 0x8000 or distance > self.mask:
+            self.dropped += 1 # either too late (already played out) or too far ahead
+            counter_jitter_buffer_drops.add(1)
+            return False
+        slot = self.slots[sequence & self.mask]
+        if slot.sequence == sequence:
+            return False # duplicate
+        slot.sequence = sequence
+        slot.timestamp = timestamp
+        slot.payload = payload
+        self.count += 1
+        if distance + 1 > self.span:
+            self.span = distance + 1
+        return True
+
+    def peek(self):
+        # returns the number of missing packets in front of the next available one, and that one
+        for missing in range(self.span):
+            sequence = (self.next_sequence + missing) & 0xFFFF
+            slot = self.slots[sequence & self.mask]
+            if slot.sequence == sequence:
+                return missing, slot
+        return None, None
+
+    def has_next(self):
+        return self.count > 0 and self.slots[self.next_sequence & self.mask].sequence == self.next_sequence
+
+    def pop(self, slot):
+        missing = (slot.sequence - self.next_sequence) & 0xFFFF
+        self.started = True
+        self.next_sequence = (slot.sequence + 1) & 0xFFFF
+        self.span -= missing + 1
+        self.count -= 1
+        slot.sequence = None
+        payload = slot.payload
+        slot.payload = None
+        return payload
+
+counter_concealed_frames = meter.create_counter(name = 'discord.gateway.voice.decoder.concealed_frames', description = 'Number of lost frames concealed by the decoder', unit="count")
+counter_recovered_frames = meter.create_counter(name = 'discord.gateway.voice.decoder.recovered_frames', description = 'Number of lost frames recovered from forward error correction data', unit="count")
+live_decoders_lock = threading.Lock()
+live_decoders = 0
+
+def get_live_decoders(options):
+    with live_decoders_lock:
+        yield metrics.Observation(live_decoders)
+
+meter.create_observable_gauge('discord.gateway.voice.decoder.live', [get_live_decoders])
+
+def create_opus_decoder():
+    error = ctypes.c_int(0)
+    decoder = pyogg.opus.opus_decoder_create(pyogg.opus.opus_int32(frame_rate), ctypes.c_int(channels), ctypes.byref(error))
+    if error.value != 0:
+        raise RuntimeError(str(error.value))
+    return decoder
+
+class DecoderPool:
+    # decoder state must not be shared across speakers, so every ssrc gets its own decoder, created lazily and evicted when idle
+    decoders = None
+
+    def __init__(self):
+        self.decoders = {}
+
+    def __get(self, ssrc):
+        global live_decoders
+        entry = self.decoders.get(ssrc)
+        if not entry:
+            if len(self.decoders) >= DECODER_POOL_MAX:
+                self.__destroy(min(self.decoders.keys(), key=lambda ssrc: self.decoders[ssrc][1]))
+            entry = self.decoders[ssrc] = [create_opus_decoder(), None]
+            with live_decoders_lock:
+                live_decoders += 1
+        entry[1] = time_millis()
+        return entry[0]
+
+    def __destroy(self, ssrc):
+        global live_decoders
+        decoder, last_used = self.decoders.pop(ssrc)
+        pyogg.opus.opus_decoder_destroy(decoder)
+        with live_decoders_lock:
+            live_decoders -= 1
+
+    def __decode(self, decoder, payload, fec, output):
+        # without payload, the decoder conceals the frame (packet loss concealment), a short frame leaves the rest of the output silent
+        pyogg.opus.opus_decode(decoder, ctypes.cast(payload, pyogg.opus.c_uchar_p) if payload else None, pyogg.opus.opus_int32(len(payload) if payload else 0), ctypes.cast(output, pyogg.opus.opus_int16_p), ctypes.c_int(desired_frame_size), ctypes.c_int(1 if fec else 0))
+
+    def decode(self, ssrc, payload, missing = 0):
+        # decodes a frame, preceded by the given number of lost frames
+        return self.decode_batch(ssrc, [(payload, missing)])
+
+    def decode_batch(self, ssrc, frames):
+        # decodes a list of (payload, missing) straight into one pcm buffer
+        decoder = self.__get(ssrc)
+        frame_bytes = desired_frame_size * sample_width * channels
+        pcm = bytearray(frame_bytes * sum(missing + 1 for payload, missing in frames))
+        address = ctypes.addressof((ctypes.c_char * len(pcm)).from_buffer(pcm))
+        offset = 0
+        concealed_total = 0
+        recovered_total = 0
+        for payload, missing in frames:
+            if missing > 0:
+                concealed = min(missing - 1, MAX_CONCEALED_FRAMES)
+                for _ in range(concealed):
+                    self.__decode(decoder, None, False, address + offset)
+                    offset += frame_bytes
+                offset += frame_bytes * (missing - 1 - concealed) # stays silent
+                self.__decode(decoder, payload, True, address + offset) # the frame right before can be recovered from the in-band forward error correction data of this one
+                offset += frame_bytes
+                concealed_total += concealed
+                recovered_total += 1
+            self.__decode(decoder, payload, False, address + offset)
+            offset += frame_bytes
+        if recovered_total > 0:
+            counter_concealed_frames.add(concealed_total)
+            counter_recovered_frames.add(recovered_total)
+        return pcm
+
+    def evict(self, max_idle = DECODER_IDLE_TIMEOUT):
+        now = time_millis()
+        for ssrc in [ssrc for ssrc, entry in self.decoders.items() if entry[1] + max_idle < now]:
+            self.__destroy(ssrc)
+
+    def close(self):
+        for ssrc in list(self.decoders.keys()):
+            self.__destroy(ssrc)
+
+class FrameProcessor:
+    # applies volume and loudness normalization to the pre-encoded frames of one stream and mixes in an overlay,
+    # frames are only decoded and re-encoded while any of that is active, otherwise they pass through untouched
+    # (the decoders are its own, the decoder pool and its metrics are about received audio)
+    decoder = None
+    overlay_decoder = None
+    encoder = None
+    gain = 1.0
+    target = None
+    silence = None
+
+    def __init__(self):
+        self.decoder = create_opus_decoder()
+        self.overlay_decoder = create_opus_decoder()
+        self.encoder = PacketEncoder()
+        self.target = 32767 * 10 ** (NORMALIZATION_TARGET_DBFS / 20)
+        self.silence = self.target / 100 # no point in pulling up silence
+
+    def __decode(self, decoder, opus_frame):
+        pcm = numpy.zeros(desired_frame_size * channels, dtype=numpy.int16) # a short frame leaves the rest silent
+        pyogg.opus.opus_decode(decoder, ctypes.cast(opus_frame, pyogg.opus.c_uchar_p), pyogg.opus.opus_int32(len(opus_frame)), pcm.ctypes.data_as(pyogg.opus.opus_int16_p), ctypes.c_int(desired_frame_size), ctypes.c_int(0))
+        return pcm
+
+    def process(self, opus_frame, overlay_frame, volume, normalize):
+        pcm = self.__decode(self.decoder, opus_frame).astype(numpy.float32)
+        if normalize:
+            # the gain follows the loudness of the recent frames smoothly instead of jumping per frame
+            rms = numpy.sqrt(numpy.mean(pcm * pcm))
+            if rms > self.silence:
+                self.gain += (min(NORMALIZATION_MAX_GAIN, self.target / rms) - self.gain) * NORMALIZATION_SMOOTHING
+        else:
+            self.gain = 1.0
+        pcm *= volume * self.gain
+        if overlay_frame:
+            pcm += self.__decode(self.overlay_decoder, overlay_frame)
+        return self.encoder.encode(numpy.clip(pcm, -32768, 32767).astype(numpy.int16).tobytes())
+
+    def close(self):
+        pyogg.opus.opus_decoder_destroy(self.decoder)
+        pyogg.opus.opus_decoder_destroy(self.overlay_decoder)
+        self.encoder.close()
+
+def timestamp_distance(timestamp_from, timestamp_to):
+    # rtp timestamps are 32 bit and wrap around
+    distance = (timestamp_to - timestamp_from) & 0xFFFFFFFF
+    return distance - 0x100000000 if distance >= 0x80000000 else distance
+
+def opus_packet_samples(packet):
+    # https://datatracker.ietf.org/doc/html/rfc6716#section-3.1
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:
+        frame_size = [480, 960, 1920, 2880][config % 4]
+    elif config < 16:
+        frame_size = [480, 960][config % 2]
+    else:
+        frame_size = [120, 240, 480, 960][config % 4]
+    match toc & 0x03:
+        case 0:
+            frames = 1
+        case 1 | 2:
+            frames = 2
+        case _:
+            frames = packet[1] & 0x3F if len(packet) > 1 else 0
+    return frames * frame_size
+
+def create_ogg_crc_table():
+    table = []
+    for i in range(256):
+        r = i << 24
+        for _ in range(8):
+            r = ((r << 1) ^ 0x04C11DB7) if r & 0x80000000 else (r << 1)
+        table.append(r & 0xFFFFFFFF)
+    return table
+
+ogg_crc_table = create_ogg_crc_table()
+
+def ogg_crc(data):
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ ogg_crc_table[((crc >> 24) ^ byte) & 0xFF]
+    return crc
+
+class OggOpusWriter:
+    # muxes already encoded opus packets into an ogg opus file (https://datatracker.ietf.org/doc/html/rfc7845)
+    file = None
+    serial = None
+    page_sequence = 0
+    segments = None
+    packets = None
+    first_timestamp = None
+    granule = 0
+    max_packets_per_page = 10 # short pages so the recording can be tailed while it is written
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.serial = random.randint(0, 0xFFFFFFFF)
+        self.segments = []
+        self.packets = []
+        head = b'OpusHead' + struct.pack('<BBHIhB', 1, channels, 0, frame_rate, 0, 0)
+        self.__write_page([head], 0, 0x02)
+        vendor = b'philbot-voice'
+        tags = b'OpusTags' + struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', 0)
+        self.__write_page([tags], 0, 0x00)
+
+    def __write_page(self, packets, granule, header_type):
+        lacing = bytearray()
+        for packet in packets:
+            lacing += b'\xFF' * (len(packet) // 255) + bytes([len(packet) % 255])
+        header = bytearray(b'OggS' + struct.pack('<BBqIIIB', 0, header_type, granule, self.serial, self.page_sequence, 0, len(lacing)) + lacing)
+        body = b''.join(packets)
+        struct.pack_into('<I', header, 22, ogg_crc(header + body))
+        self.file.write(header)
+        self.file.write(body)
+        self.file.flush()
+        self.page_sequence += 1
+
+    def __write_packet(self, packet):
+        segments = len(packet) // 255 + 1
+        if self.packets and (len(self.segments) + segments > 255 or len(self.packets) >= self.max_packets_per_page):
+            self.__flush_page(0x00)
+        self.packets.append(packet)
+        self.segments += [None] * segments
+
+    def __flush_page(self, header_type):
+        self.__write_page(self.packets, self.granule, header_type)
+        self.packets = []
+        self.segments = []
+
+    def write(self, timestamp, packet):
+        # granule positions follow the rtp timestamps, gaps are filled with silence
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        position = timestamp_distance(self.first_timestamp, timestamp)
+        while position - self.granule >= desired_frame_size:
+            self.__write_packet(b"\xF8\xFF\xFE")
+            self.granule += desired_frame_size
+        self.__write_packet(packet)
+        self.granule = max(self.granule, position) + opus_packet_samples(packet)
+
+    def close(self):
+        if self.packets or self.page_sequence <= 2:
+            self.__flush_page(0x04)
+        self.file.close()
+
+recordings_lock = threading.Lock()
+recordings = set()
+
+def is_recording(path):
+    with recordings_lock:
+        return path in recordings
+
+counter_vad_kept = meter.create_counter(name = 'discord.gateway.voice.vad.kept', description = 'Amount of received audio kept in recordings', unit="milliseconds")
+counter_vad_dropped = meter.create_counter(name = 'discord.gateway.voice.vad.dropped', description = 'Amount of received audio dropped as silence or too short utterances', unit="milliseconds")
+
+class VoiceActivityGate:
+    # decides whether a received frame is voiced, by the energy of the decoded frame, or by the size of the opus packet if recordings are not decoded (ogg)
+    enabled = VAD_ENABLED
+    threshold_dbfs = VAD_THRESHOLD_DBFS
+    min_packet_size = VAD_MIN_PACKET_SIZE
+    min_voiced_duration = VAD_MIN_VOICED_DURATION
+    hangover = VAD_HANGOVER
+    threshold = None
+
+    def __init__(self, settings = None):
+        self.update(settings or {})
+
+    def update(self, settings):
+        # validates everything before applying anything
+        if not isinstance(settings, dict):
+            raise ValueError('settings must be an object')
+        enabled = settings.get('enabled', self.enabled)
+        if not isinstance(enabled, bool):
+            raise ValueError('enabled must be a boolean')
+        for key in ['threshold_dbfs', 'min_packet_size', 'min_voiced_duration', 'hangover']:
+            value = settings.get(key, getattr(self, key))
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(key + ' must be a number')
+        threshold_dbfs = float(settings.get('threshold_dbfs', self.threshold_dbfs))
+        min_packet_size = int(settings.get('min_packet_size', self.min_packet_size))
+        min_voiced_duration = int(settings.get('min_voiced_duration', self.min_voiced_duration))
+        hangover = int(settings.get('hangover', self.hangover))
+        if threshold_dbfs > 0 or min_packet_size < 0 or min_voiced_duration < 0 or hangover < 0:
+            raise ValueError('settings out of range')
+        self.enabled, self.threshold_dbfs, self.min_packet_size, self.min_voiced_duration, self.hangover = enabled, threshold_dbfs, min_packet_size, min_voiced_duration, hangover
+        self.threshold = 32767 * 10 ** (threshold_dbfs / 20)
+
+    def to_json(self):
+        return {
+            'enabled': self.enabled,
+            'threshold_dbfs': self.threshold_dbfs,
+            'min_packet_size': self.min_packet_size,
+            'min_voiced_duration': self.min_voiced_duration,
+            'hangover': self.hangover
+        }
+
+    def is_voiced(self, payload, pcm = None):
+        if pcm is None:
+            return len(payload) >= self.min_packet_size
+        samples = numpy.frombuffer(pcm, dtype=numpy.int16).astype(numpy.float32)
+        return numpy.sqrt(numpy.mean(samples * samples)) >= self.threshold
 
 class Stream:
     guild_id = None
     channel_id = None
     user_id = None
+    decoders = None
+    gate = None
+    ssrc = None
     nonce = None
+    path = None
     file = None
+    raw_file = None
     packages = None
-    last_sequence = None
+    voiced_packages = 0
+    held = None
+    held_packages = 0
+    trimming = False
+    dropped = False
+    timestamp_offset = 0
     last_timestamp = None
     buffer = None
     buffer_revision = None
 
-    def __init__(self, guild_id, channel_id, user_id):
+    def __init__(self, guild_id, channel_id, user_id, decoders, gate):
         self.guild_id = guild_id
         self.channel_id = channel_id
         self.user_id = user_id
+        self.decoders = decoders
+        self.gate = gate
     
     def get_nonce(self):
         return self.nonce
@@ -340,82 +1939,566 @@ class Stream:
     def get_duration_secs(self):
         return self.packages * frame_duration / 1000
 
-    def write(self, sequence, timestamp, pcm, nonce):
-        if not self.file:
+    def is_kept(self):
+        # whether the recording made it to disk, with the gate it may have been all silence or too short
+        return self.path is not None and not self.dropped
+
+    def write(self, sequence, timestamp, ssrc, payload, nonce):
+        if not self.buffer:
             self.nonce = nonce
-            self.file = wave.open(generate_audio_file_path(self.guild_id, self.channel_id, self.user_id, nonce, 'wav'), 'wb')
-            self.file.setsampwidth(sample_width)
-            self.file.setnchannels(channels)
-            self.file.setframerate(frame_rate)
             self.packages = 0
-            self.last_sequence = None
+            self.voiced_packages = 0
+            self.held = []
+            self.held_packages = 0
+            self.trimming = False
+            self.dropped = False
+            self.timestamp_offset = 0
             self.last_timestamp = None
-            self.buffer = {}
+            self.buffer = JitterBuffer(JITTER_BUFFER_CAPACITY)
             self.buffer_revision = None
-        self.buffer[sequence] = Packet(sequence, timestamp, pcm)
+        self.ssrc = ssrc
+        self.buffer.insert(sequence, timestamp, payload)
         self.buffer_revision = time_millis()
+
+    def __open(self):
+        # the file is only created with the first frame that is kept
+        self.path = generate_audio_file_path(self.guild_id, self.channel_id, self.user_id, self.nonce, 'ogg' if RECORDING_FORMAT == 'ogg' else 'wav')
+        if RECORDING_FORMAT == 'ogg':
+            self.file = OggOpusWriter(self.path)
+        else:
+            self.raw_file = open(self.path, 'wb', buffering=0) # unbuffered so the recording can be tailed while it is written
+            self.file = wave.open(self.raw_file, 'wb')
+            self.file.setsampwidth(sample_width)
+            self.file.setnchannels(channels)
+            self.file.setframerate(frame_rate)
+        with recordings_lock:
+            recordings.add(self.path)
+        cache_index.pin(self.path)
+
+    def __append(self, timestamp, payload, missing_packages, pcm):
+        if not self.file:
+            self.__open()
+        if RECORDING_FORMAT == 'ogg':
+            self.file.write((timestamp - self.timestamp_offset) & 0xFFFFFFFF, payload)
+        else:
+            self.file.writeframes(pcm)
+        self.packages += missing_packages + 1
+
+    def __drop(self, packages):
+        # later frames move up by the dropped span, otherwise the ogg writer would fill it with silence again
+        self.timestamp_offset += packages * desired_frame_size
+        counter_vad_dropped.add(packages * frame_duration, { "discord.guild.id": self.guild_id })
+
+    def __release_held(self, limit = None):
+        # writes the held back silence (up to the limit in packages), drops the rest
+        written = 0
+        for timestamp, payload, missing_packages, pcm in self.held:
+            if limit is not None and written + missing_packages + 1 > limit:
+                break
+            self.__append(timestamp, payload, missing_packages, pcm)
+            written += missing_packages + 1
+        if self.held_packages > written:
+            self.__drop(self.held_packages - written)
+        self.held = []
+        self.held_packages = 0
+
+    def __write(self, entries):
+        # entries are (timestamp, payload, missing packages before), in wav mode they are decoded in one batch
+        pcm = None
+        if RECORDING_FORMAT != 'ogg':
+            pcm = self.decoders.decode_batch(self.ssrc, [(payload, missing_packages) for timestamp, payload, missing_packages in entries])
+        if not self.gate.enabled:
+            if RECORDING_FORMAT == 'ogg':
+                for timestamp, payload, missing_packages in entries:
+                    self.__append(timestamp, payload, missing_packages, None)
+            else:
+                self.__append(None, None, len(pcm) // (desired_frame_size * sample_width * channels) - 1, pcm)
+            return
+        # silence before the first voiced frame is trimmed to the hangover, silence after a voiced frame is held back up to the max pause,
+        # if voice does not come back by then only the hangover is kept and further silence is trimmed
+        frame_bytes = desired_frame_size * sample_width * channels
+        hangover_packages = self.gate.hangover // frame_duration
+        pause_packages = VAD_MAX_PAUSE // frame_duration
+        view = memoryview(pcm) if pcm is not None else None
+        offset = 0
+        for timestamp, payload, missing_packages in entries:
+            packages = missing_packages + 1
+            chunk = None
+            if view is not None:
+                chunk = view[offset:offset + packages * frame_bytes]
+                offset += packages * frame_bytes
+            if self.gate.is_voiced(payload, chunk[-frame_bytes:] if chunk is not None else None):
+                self.__release_held()
+                self.trimming = False
+                self.voiced_packages += packages
+                self.__append(timestamp, payload, missing_packages, chunk)
+                continue
+            self.held.append((timestamp, payload, missing_packages, chunk))
+            self.held_packages += packages
+            if self.file and not self.trimming:
+                if self.held_packages > pause_packages:
+                    self.__release_held(hangover_packages)
+                    self.trimming = True
+            else:
+                while self.held_packages > hangover_packages:
+                    dropped = self.held.pop(0)
+                    self.held_packages -= dropped[2] + 1
+                    self.__drop(dropped[2] + 1)
     
     def try_flush(self, limit = 1000):
-        if not self.file:
+        if not self.buffer:
             return False
         # some basic threasholds
         too_young_packages = max(0, limit - ((time_millis() - self.buffer_revision) if self.buffer_revision else 0)) // frame_duration
         min_pause_duration = 1000
-        # find first earliest sequence in case we are just starting
-        if not self.last_sequence:
-            for sequence in self.buffer.keys():
-                if not self.last_sequence or self.last_sequence > sequence:
-                    self.last_sequence = sequence
-            if not self.last_sequence:
-                return False
-            self.last_timestamp = self.buffer[self.last_sequence].get_timestamp() - desired_frame_size
-            self.last_sequence = self.last_sequence - 1
         # write packages and fill holes
         do_flush = False
-        while len(self.buffer) > too_young_packages or (len(self.buffer) > 0 and self.buffer.get(self.last_sequence + 1)):
-            sequence = (self.last_sequence + 1) & 0xFFFF
-            missing_packages = 0
-            while not self.buffer.get(sequence):
-                sequence = (sequence + 1) & 0xFFFF
-                missing_packages += 1
-            packet = self.buffer.get(sequence)
-            if packet.get_timestamp() > self.last_timestamp + (desired_frame_size * min_pause_duration // frame_duration):
+        entries = []
+        while len(self.buffer) > too_young_packages or self.buffer.has_next():
+            missing_packages, slot = self.buffer.peek()
+            if self.last_timestamp is None:
+                self.last_timestamp = slot.timestamp - desired_frame_size
+            if timestamp_distance(self.last_timestamp, slot.timestamp) > desired_frame_size * min_pause_duration // frame_duration:
                 do_flush = True
                 break
-            self.buffer.pop(sequence)
-            self.file.writeframes(b"\x00" * sample_width * channels * desired_frame_size * missing_packages)
-            self.file.writeframes(packet.get_pcm())
-            self.packages += missing_packages + 1
-            self.last_sequence = packet.get_sequence()
-            self.last_timestamp = packet.get_timestamp()
+            timestamp = slot.timestamp
+            payload = self.buffer.pop(slot)
+            entries.append((timestamp, payload, missing_packages))
+            self.last_timestamp = timestamp
+        if entries:
+            self.__write(entries)
         # check whether we ran out completely
         if len(self.buffer) == 0 and too_young_packages == 0:
             do_flush = True
         # flush if necessary
         if do_flush:
-            self.file.close()
-            self.file = None
-            from_path = generate_audio_file_path(self.guild_id, self.channel_id, self.user_id, self.nonce, 'wav')
-            to_path = generate_audio_file_path(self.guild_id, self.channel_id, self.user_id, self.nonce, 'mp3')
-            observed_subprocess_run(['ffmpeg', '-i', from_path, '-y', to_path]).check_returncode()
-            os.remove(from_path)
+            self.__close()
         return do_flush
 
     def flush(self):
         return self.try_flush(0)
 
+    def __close(self):
+        # trailing silence is trimmed to the hangover (unless that has been written already)
+        if self.file and not self.trimming:
+            self.__release_held(self.gate.hangover // frame_duration)
+        elif self.held_packages > 0:
+            self.__drop(self.held_packages)
+        self.held = []
+        self.held_packages = 0
+        if not self.file:
+            return
+        self.file.close()
+        self.file = None
+        if self.raw_file:
+            self.raw_file.close()
+            self.raw_file = None
+        with recordings_lock:
+            recordings.discard(self.path)
+        if self.gate.enabled and self.voiced_packages * frame_duration < self.gate.min_voiced_duration:
+            self.dropped = True
+            cache_index.remove(self.path)
+            self.__drop(self.packages)
+            return
+        cache_index.add(self.path, CACHE_TEMPORARY_MAX_AGE)
+        cache_index.unpin(self.path)
+        counter_vad_kept.add(self.packages * frame_duration, { "discord.guild.id": self.guild_id })
+
     def reset(self):
-        if self.file:
-            self.file.close()
+        if self.buffer:
+            self.__close()
         self.nonce = None
-        self.file = None
+        self.path = None
         self.packages = None
-        self.last_sequence = None
+        self.held = None
+        self.last_timestamp = None
         self.buffer = None
         self.buffer_revision = None
 
+class AsyncioVoiceEngine:
+    # a single event loop drives websockets, udp sockets and frame timers of all connections, blocking work goes to bounded pools that cannot starve each other
+    # gateway message handling runs on the executor, frame production and recording on the media pool, and ffmpeg conversions on the conversion pool
+    loop = None
+    executor = None
+    media = None
+    conversions = None
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=VOICE_ENGINE_WORKERS)
+        self.media = concurrent.futures.ThreadPoolExecutor(max_workers=VOICE_ENGINE_MEDIA_WORKERS)
+        self.conversions = concurrent.futures.ThreadPoolExecutor(max_workers=VOICE_ENGINE_CONVERSION_WORKERS)
+        threading.Thread(target=self.__run).start()
+
+    def __run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coroutine):
+        return AsyncioVoiceTask(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+    def spawn(self, target, *args, **kwargs):
+        return self.executor.submit(target, *args, **kwargs)
+
+    def convert(self, target, *args, **kwargs):
+        return self.conversions.submit(target, *args, **kwargs)
+
+    def call_later(self, delay, target):
+        # waits on the loop instead of holding a worker, then runs the target on the executor
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, self.spawn, target)
+
+class AsyncioVoiceTask:
+    # mimics the parts of threading.Thread the connection relies on
+    future = None
+
+    def __init__(self, future):
+        self.future = future
+
+    def is_alive(self):
+        return not self.future.done()
+
+    def join(self):
+        try:
+            self.future.result()
+        except Exception:
+            pass
+
+class AsyncioWebSocketApp:
+    # mimics the parts of websocket.WebSocketApp the connection relies on, callbacks are dispatched in order to the engine's pool so they may block
+    url = None
+    on_open = None
+    on_message = None
+    on_error = None
+    on_close = None
+    ws = None
+    closing = False
+
+    def __init__(self, url, on_open, on_message, on_error, on_close):
+        self.url = url
+        self.on_open = on_open
+        self.on_message = on_message
+        self.on_error = on_error
+        self.on_close = on_close
+
+    def run_forever(self):
+        return voice_engine.run(self.__run())
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        async def dispatch():
+            while True:
+                callback, args = await events.get()
+                try:
+                    await loop.run_in_executor(voice_engine.executor, callback, self, *args)
+                except Exception as e:
+                    print('VOICE GATEWAY callback failed: ' + str(e))
+                if callback == self.on_close:
+                    break
+        dispatcher = asyncio.create_task(dispatch())
+        try:
+            async with websockets.connect(self.url, max_size=None) as ws:
+                self.ws = ws
+                if self.closing:
+                    await ws.close()
+                events.put_nowait((self.on_open, ()))
+                async for message in ws:
+                    events.put_nowait((self.on_message, (message,)))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            events.put_nowait((self.on_error, (e,)))
+        events.put_nowait((self.on_close, (self.ws.close_code if self.ws else None, self.ws.close_reason if self.ws else None)))
+        await dispatcher
+
+    def send(self, message):
+        if not self.ws:
+            raise RuntimeError('not connected')
+        asyncio.run_coroutine_threadsafe(self.ws.send(message), voice_engine.loop)
+
+    def close(self):
+        self.closing = True
+        if self.ws:
+            asyncio.run_coroutine_threadsafe(self.ws.close(), voice_engine.loop)
+
+voice_engine = None
+
+class FrameTickerEntry:
+    # mimics the parts of threading.Thread the connection relies on
+    state = None
+    produce = None
+    send = None
+    report = None
+    close = None
+    heartbeat = None
+    heartbeat_due = 0
+    finished = None
+
+    def __init__(self, state, produce, send, report, close, heartbeat):
+        self.state = state
+        self.produce = produce
+        self.send = send
+        self.report = report
+        self.close = close
+        self.heartbeat = heartbeat
+        self.finished = threading.Event()
+
+    def is_alive(self):
+        return not self.finished.is_set()
+
+    def join(self):
+        self.finished.wait()
+
+class FrameTicker:
+    # one thread wakes up every frame, prepares the frames of all connections in a batch and sends them together,
+    # idle connections are set aside until they are woken up and only get their heartbeats
+    condition = None
+    entries = None
+    sleeping = None
+    thread = None
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.entries = []
+        self.sleeping = []
+
+    def register(self, open, produce, send, report, close, heartbeat):
+        try:
+            entry = FrameTickerEntry(open(), produce, send, report, close, heartbeat)
+        except Exception as e:
+            print('VOICE TICKER failed to open stream: ' + str(e))
+            entry = FrameTickerEntry(None, produce, send, report, close, heartbeat)
+            entry.finished.set()
+            return entry
+        with self.condition:
+            self.entries.append(entry)
+            if not self.thread:
+                self.thread = threading.Thread(target=self.__run)
+                self.thread.start()
+            self.condition.notify_all()
+        return entry
+
+    def wake(self, entry):
+        with self.condition:
+            if entry in self.sleeping:
+                self.sleeping.remove(entry)
+                self.entries.append(entry)
+                self.condition.notify_all()
+
+    def __finish(self, entry):
+        try:
+            entry.close(entry.state)
+        finally:
+            entry.finished.set()
+
+    def __heartbeat(self, entry):
+        try:
+            entry.heartbeat_due = time_millis() + entry.heartbeat(entry.state)
+        except Exception as e:
+            print('VOICE TICKER failed to heartbeat: ' + str(e))
+
+    def __run(self):
+        scheduler = None
+        budget = frame_duration * 1000000
+        while True:
+            with self.condition:
+                while not self.entries:
+                    scheduler = None
+                    now = time_millis()
+                    for entry in [entry for entry in self.sleeping if entry.heartbeat_due <= now]:
+                        self.__heartbeat(entry)
+                    self.condition.wait(max(0, min(entry.heartbeat_due for entry in self.sleeping) - time_millis()) / 1000 if self.sleeping else None)
+                entries = list(self.entries)
+                sleeping = list(self.sleeping)
+            if not scheduler:
+                scheduler = FrameScheduler()
+            start = time.monotonic_ns()
+            batch = []
+            for entry in entries:
+                try:
+                    package = entry.produce(entry.state)
+                except Exception as e:
+                    print('VOICE TICKER failed to produce frame: ' + str(e))
+                    package = None
+                if package:
+                    batch.append((entry, package))
+                elif package is not None:
+                    with self.condition:
+                        self.entries.remove(entry)
+                        self.sleeping.append(entry)
+                    self.__heartbeat(entry)
+                else:
+                    with self.condition:
+                        self.entries.remove(entry)
+                    self.__finish(entry)
+            for entry, package in batch:
+                entry.send(entry.state, package)
+                entry.heartbeat(entry.state)
+            now = time_millis()
+            for entry in sleeping:
+                if entry.heartbeat_due <= now:
+                    self.__heartbeat(entry)
+            duration = time.monotonic_ns() - start
+            histogram_tick_duration.record(duration / 1000000)
+            histogram_tick_connections.record(len(batch))
+            histogram_tick_utilization.record(duration * 100 / budget)
+            if duration > budget:
+                counter_tick_overruns.add(1)
+            lateness, skipped = scheduler.wait()
+            if lateness > 0 or skipped > 0:
+                for entry, package in batch:
+                    entry.report(entry.state, lateness, skipped)
+
+frame_ticker = None
+
+histogram_callback_latency = meter.create_histogram(name = 'discord.gateway.voice.callbacks.latency', description = 'Time from queueing a callback until it has been delivered', unit="milliseconds")
+counter_callback_failures = meter.create_counter(name = 'discord.gateway.voice.callbacks.failures', description = 'Number of failed callback deliveries', unit="count")
+counter_callback_drops = meter.create_counter(name = 'discord.gateway.voice.callbacks.drops', description = 'Number of callbacks given up on', unit="count")
+counter_callback_spills = meter.create_counter(name = 'discord.gateway.voice.callbacks.spills', description = 'Number of callbacks spilled to disk because the queue was full', unit="count")
+
+class CallbackDispatcher:
+    # delivers callbacks with a fixed pool of workers and keep-alive connections, retries are scheduled rather than slept,
+    # and once the in-memory queue is full callbacks spill to disk (so they also survive restarts)
+    condition = None
+    queue = None
+    counter = 0
+    spilled = 0
+    session = None
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queue = []
+        self.session = requests.Session()
+        self.session.verify = False
+        self.spilled = len(self.__list_spilled())
+        for _ in range(CALLBACK_WORKERS):
+            threading.Thread(target=self.__run).start()
+
+    def dispatch(self, url, reason, body):
+        self.__enqueue({ 'url': url, 'reason': reason, 'body': body, 'created': time_millis(), 'delay': 1000 }, time_millis())
+
+    def __enqueue(self, event, not_before):
+        with self.condition:
+            if len(self.queue) >= CALLBACK_QUEUE_SIZE:
+                self.__spill(event)
+                return
+            self.counter += 1
+            heapq.heappush(self.queue, (not_before, self.counter, event))
+            self.condition.notify()
+
+    def __list_spilled(self):
+        return [file for file in os.listdir(CALLBACK_SPILL_DIRECTORY) if file.startswith('.callback.') and file.endswith('.json')]
+
+    def __spill(self, event):
+        with open(CALLBACK_SPILL_DIRECTORY + '/.callback.' + str(event['created']) + '.' + str(uuid.uuid4()) + '.json', 'w') as file:
+            file.write(json.dumps(event))
+        self.spilled += 1
+        counter_callback_spills.add(1)
+
+    def __unspill(self):
+        # refill the queue from disk, oldest first
+        for file in sorted(self.__list_spilled())[:CALLBACK_QUEUE_SIZE - len(self.queue)]:
+            path = CALLBACK_SPILL_DIRECTORY + '/' + file
+            try:
+                with open(path, 'r') as f:
+                    event = json.loads(f.read())
+                self.counter += 1
+                heapq.heappush(self.queue, (time_millis(), self.counter, event))
+            except:
+                pass
+            try:
+                os.remove(path)
+            except:
+                pass
+        self.spilled = len(self.__list_spilled())
+
+    def __take(self):
+        with self.condition:
+            while True:
+                if self.spilled > 0 and len(self.queue) < CALLBACK_QUEUE_SIZE // 2:
+                    self.__unspill()
+                if self.queue and self.queue[0][0] <= time_millis():
+                    break
+                self.condition.wait((self.queue[0][0] - time_millis()) / 1000 if self.queue else None)
+            not_before, counter, event = heapq.heappop(self.queue)
+            if CALLBACK_BATCH_SIZE <= 1 or event['reason'] != 'voice_audio':
+                return [event]
+            batch = [event]
+            now = time_millis()
+            remaining = []
+            for item in self.queue:
+                if len(batch) < CALLBACK_BATCH_SIZE and item[0] <= now and item[2]['reason'] == event['reason'] and item[2]['url'] == event['url']:
+                    batch.append(item[2])
+                else:
+                    remaining.append(item)
+            if len(batch) > 1:
+                heapq.heapify(remaining)
+                self.queue = remaining
+            return batch
+
+    def __run(self):
+        while True:
+            batch = self.__take()
+            try:
+                if len(batch) == 1:
+                    response = self.session.post(batch[0]['url'] + '/' + batch[0]['reason'], json=batch[0]['body'], headers={ 'x-authorization': os.environ['DISCORD_API_TOKEN'] }, timeout=30)
+                else:
+                    response = self.session.post(batch[0]['url'] + '/' + batch[0]['reason'] + '_batch', json=[event['body'] for event in batch], headers={ 'x-authorization': os.environ['DISCORD_API_TOKEN'] }, timeout=30)
+                if response.status_code >= 500:
+                    raise RuntimeError(str(response.status_code))
+                for event in batch:
+                    histogram_callback_latency.record(time_millis() - event['created'], { 'reason': event['reason'] })
+            except Exception:
+                counter_callback_failures.add(1)
+                for event in batch:
+                    if event['created'] + CALLBACK_MAX_AGE < time_millis():
+                        counter_callback_drops.add(1, { 'reason': event['reason'] })
+                        continue
+                    delay = event['delay']
+                    event['delay'] = min(delay * 2, 1000 * 60)
+                    self.__enqueue(event, time_millis() + delay)
+
+    def get_depth(self):
+        with self.condition:
+            return len(self.queue) + self.spilled
+
+callback_dispatcher = None
+
+def get_callback_queue_depth(options):
+    yield metrics.Observation(callback_dispatcher.get_depth() if callback_dispatcher else 0)
+
+meter.create_observable_gauge('discord.gateway.voice.callbacks.queued', [get_callback_queue_depth])
+
+def convert_recording(guild_id, channel_id, user_id, nonce):
+    from_path = generate_audio_file_path(guild_id, channel_id, user_id, nonce, 'wav')
+    to_path = generate_audio_file_path(guild_id, channel_id, user_id, nonce, 'mp3')
+    observed_subprocess_run(['ffmpeg', '-i', from_path, '-y', to_path]).check_returncode()
+    cache_index.add(to_path, CACHE_TEMPORARY_MAX_AGE)
+    cache_index.remove(from_path)
+
+class ListenState:
+    channel_id = None
+    packages = None
+    opener = None
+    decoders = None
+    streams = None
+
+class StreamState:
+    builder = None
+    metric_dimensions = None
+    sequence = 0
+    path = None
+    file = None
+    overlay_path = None
+    overlay_file = None
+    processor = None
+    silence_frames = 0
+    idle = False
+    last_heartbeat = None
+    last_heartbeat_sequence = 0
+
 class Connection:
-    lock = threading.Lock()
+    lock = None
     callback_url = None
     guild_id = None
     channel_id = None
@@ -425,6 +2508,13 @@ class Connection:
     token = None
     path = None
     paused = False
+    volume = 1.0
+    normalize = False
+    overlay_path = None
+    seek_frame = None
+    position_secs = None
+    duration_secs = None
+    wakeup = None
 
     ws = None
     socket = None
@@ -435,13 +2525,17 @@ class Connection:
     mode = None
     secret_key = None
 
-    ssrc_to_client_user_id = {}
+    ssrc_to_client_user_id = None
 
     listener = None
     streamer = None
+    gate = None
 
     def __init__(self, guild_id):
+        self.lock = threading.Lock()
+        self.ssrc_to_client_user_id = {}
         self.guild_id = guild_id
+        self.gate = VoiceActivityGate()
         try:
             with open(SESSION_DIRECTORY + '/.state.' + self.guild_id + '.json', 'r') as file:
                 state = json.loads(file.read())
@@ -455,6 +2549,9 @@ class Connection:
                 self.token = state['token']
                 self.path = state['path']
                 self.paused = state['paused']
+                self.volume = state.get('volume', 1.0)
+                self.normalize = state.get('normalize', False)
+                self.gate.update(state.get('vad', {}))
         except:
             pass
         self.__try_start()
@@ -473,7 +2570,10 @@ class Connection:
                         'endpoint': self.endpoint,
                         'token': self.token,
                         'path': self.path,
-                        'paused': self.paused
+                        'paused': self.paused,
+                        'volume': self.volume,
+                        'normalize': self.normalize,
+                        'vad': self.gate.to_json()
                     }))
             else:
                 try:
@@ -481,23 +2581,16 @@ class Connection:
                 except:
                     pass
     
-    def __callback(self, reason, body = {}):
-        delay = 1
-        while True:
-            if delay > 60 * 60:
-                break
-            try:
-                body['guild_id'] = self.guild_id
-                if not body.get('channel_id'):
-                    with self.lock:
-                        if not self.channel_id:
-                            return
-                        body['channel_id'] = self.channel_id
-                requests.post(self.callback_url + '/' + reason, json=body, headers={ 'x-authorization': os.environ['DISCORD_API_TOKEN'] }, verify=False)
-                break
-            except:
-                time.sleep(delay)
-                delay *= 2
+    def __callback(self, reason, body = None):
+        # never blocks and doesnt take the lock, so it can be called from anywhere
+        body = dict(body) if body else {}
+        body['guild_id'] = self.guild_id
+        if not body.get('channel_id'):
+            channel_id = self.channel_id
+            if not channel_id:
+                return
+            body['channel_id'] = channel_id
+        callback_dispatcher.dispatch(self.callback_url, reason, body)
 
     def __callback_playback_finished(self):
         self.__callback('voice_playback_finished')
@@ -506,194 +2599,356 @@ class Connection:
         self.__callback('voice_reconnect')
 
     def __callback_audio(self, channel_id, user_id, nonce, duration_secs):
+        if RECORDING_FORMAT == 'ogg':
+            self.__callback('voice_audio', { 'channel_id': channel_id, 'user_id': user_id, 'nonce': nonce, 'format': 'ogg', 'duration_secs': duration_secs })
+            return
+        convert_recording(self.guild_id, channel_id, user_id, nonce)
         self.__callback('voice_audio', { 'channel_id': channel_id, 'user_id': user_id, 'nonce': nonce, 'format': 'mp3', 'duration_secs': duration_secs })
     
     def __resolve_client_user_id(self, ssrc):
         with self.lock:
             return self.ssrc_to_client_user_id.get(ssrc)
 
-    def __listen(self):
+    def __spawn(self, target, **kwargs):
+        if voice_engine:
+            voice_engine.convert(target, **kwargs)
+        else:
+            threading.Thread(target=target, kwargs=kwargs).start()
+
+    def __start_background(self, target, coroutine):
+        if voice_engine:
+            return voice_engine.run(coroutine())
+        thread = threading.Thread(target=target)
+        thread.start()
+        return thread
+
+    def __start_streamer(self):
+        if frame_ticker:
+            entry = frame_ticker.register(self.__stream_open, self.__stream_frame, self.__stream_send, self.__stream_lateness, self.__stream_close, self.__stream_heartbeat)
+            self.wakeup = lambda: frame_ticker.wake(entry)
+            return entry
+        return self.__start_background(self.__stream, self.__stream_async)
+
+    def __wake(self):
+        # the streamer sleeps while there is nothing to play, must be called with the lock held
+        if self.wakeup:
+            self.wakeup()
+
+    def __listen_open(self):
         print('VOICE CONNECTION ' + self.guild_id + ' listening')
-        channel_id = self.channel_id
-        buffer = b"\x00" * desired_frame_size * channels * sample_width
-        secret_box = nacl.secret.SecretBox(bytes(self.secret_key))
-        error = ctypes.c_int(0)
-        decoder = pyogg.opus.opus_decoder_create(pyogg.opus.opus_int32(frame_rate), ctypes.c_int(channels), ctypes.byref(error))
-        streams = {}
+        state = ListenState()
+        state.channel_id = self.channel_id
+        state.opener = PacketOpener(self.secret_key, self.mode)
+        state.decoders = DecoderPool()
+        state.streams = {}
+        return state
+
+    def __listen_package(self, state, package):
+        # print('VOICE CONNECTION received voice data package: ' + str(len(package)) + 'b')
+        if len(package) <= 8:
+            return
+        try:
+            sequence, timestamp, ssrc, voice_chunk = state.opener.open(package)
+        except nacl.exceptions.CryptoError:
+            return
+        user_id = self.__resolve_client_user_id(ssrc)
+        if not user_id:
+            return
+        if not state.streams.get(user_id):
+            state.streams[user_id] = Stream(self.guild_id, state.channel_id, user_id, state.decoders, self.gate)
+        state.streams[user_id].write(sequence, timestamp, ssrc, voice_chunk, random.randint(0, 1 << 30))
+
+    def __listen_flush(self, state, limit = 1000):
+        for user_id, stream in state.streams.items():
+            if stream.try_flush(limit):
+                if not stream.is_kept():
+                    pass
+                elif RECORDING_FORMAT == 'ogg':
+                    self.__callback_audio(channel_id=state.channel_id, user_id=user_id, nonce=stream.get_nonce(), duration_secs=stream.get_duration_secs())
+                else:
+                    self.__spawn(self.__callback_audio, channel_id=state.channel_id, user_id=user_id, nonce=stream.get_nonce(), duration_secs=stream.get_duration_secs())
+                stream.reset()
+        state.decoders.evict()
+
+    def __listen_close(self, state):
+        self.__listen_flush(state, 0)
+        state.decoders.close()
+        print('VOICE CONNECTION ' + self.guild_id + ' listener terminated')
+
+    def __listen(self):
+        state = self.__listen_open()
         while True:
-            for user_id, stream in streams.items():
-                if stream.try_flush():
-                    threading.Thread(target=self.__callback_audio, kwargs={'channel_id': channel_id, 'user_id': user_id, 'nonce': stream.get_nonce(), 'duration_secs': stream.get_duration_secs()}).start()
-                    stream.reset()
+            self.__listen_flush(state)
             try:
                 with self.lock:
                     if not self.listener:
                         break
                 package, address = self.socket.recvfrom(UDP_MAX_PAYLOAD)
-                # print('VOICE CONNECTION received voice data package from ' + address[0] + ':' + str(address[1]) + ': ' + str(len(data)) + 'b')
-                if len(package) <= 8:
-                    continue
-                sequence, timestamp, ssrc, voice_chunk = unwrap_voice_package(package, secret_box)
-                user_id = self.__resolve_client_user_id(ssrc)
-                if not user_id:
-                    continue
-                effective_frame_size = pyogg.opus.opus_decode(decoder, ctypes.cast(voice_chunk, pyogg.opus.c_uchar_p), pyogg.opus.opus_int32(len(voice_chunk)), ctypes.cast(buffer, pyogg.opus.opus_int16_p), ctypes.c_int(len(buffer) // channels // sample_width), ctypes.c_int(0))
-                if effective_frame_size < 0:
-                    effective_frame_size = 0
-                pcm = buffer[:effective_frame_size * sample_width * channels]
-                if effective_frame_size < desired_frame_size:
-                    pcm += b"\x00" * (desired_frame_size - effective_frame_size) * sample_width * channels
-                if not streams.get(user_id):
-                    streams[user_id] = Stream(self.guild_id, channel_id, user_id)
-                streams[user_id].write(sequence, timestamp, pcm, random.randint(0, 1 << 30))
-            except nacl.exceptions.CryptoError:
-                pass
+                self.__listen_package(state, package)
             except OSError:
                 pass
-        for user_id, stream in streams.items():
-            if stream.flush():
-                threading.Thread(target=self.__callback_audio, kwargs={'channel_id': channel_id, 'user_id': user_id, 'nonce': stream.get_nonce(), 'duration_secs': stream.get_duration_secs()}).start()
-                stream.reset()
-        pyogg.opus.opus_decoder_destroy(decoder)
-        print('VOICE CONNECTION ' + self.guild_id + ' listener terminated')
+        self.__listen_close(state)
+
+    async def __listen_async(self):
+        state = self.__listen_open()
+        loop = asyncio.get_running_loop()
+        sock = self.socket
+        fd = sock.fileno()
+        sock.setblocking(False)
+        # the loop only queues raw packages, decrypting, decoding and writing recordings happens on the media pool
+        state.packages = collections.deque(maxlen=LISTEN_QUEUE_CAPACITY)
+        def on_readable():
+            while True:
+                try:
+                    package, address = sock.recvfrom(UDP_MAX_PAYLOAD)
+                except OSError:
+                    return
+                state.packages.append(package)
+        def drain():
+            while state.packages:
+                self.__listen_package(state, state.packages.popleft())
+            self.__listen_flush(state)
+        loop.add_reader(fd, on_readable)
+        try:
+            while True:
+                with self.lock:
+                    if not self.listener:
+                        break
+                await loop.run_in_executor(voice_engine.media, drain)
+                await asyncio.sleep(0.1)
+        finally:
+            loop.remove_reader(fd)
+        await loop.run_in_executor(voice_engine.media, self.__listen_close, state)
 
-    def __stream(self):
+    def __stream_open(self):
         # https://discord.com/developers/docs/topics/voice-connections#encrypting-and-sending-voice
         # https://github.com/Rapptz/discord.py/blob/master/discord/voice_client.py
         print('VOICE CONNECTION ' + self.guild_id + ' streaming')
-
-        buffer = b"\x00" * desired_frame_size * channels * sample_width
-        secret_box = nacl.secret.SecretBox(bytes(self.secret_key))
-        error = ctypes.c_int(0)
-        encoder = pyogg.opus.opus_encoder_create(pyogg.opus.opus_int32(frame_rate), ctypes.c_int(channels), ctypes.c_int(pyogg.opus.OPUS_APPLICATION_AUDIO), ctypes.byref(error))
-        if error.value != 0:
-            raise RuntimeError(str(error.value))
-        if self.mode != "xsalsa20_poly1305":
-            raise RuntimeError('unexpected mode: ' + self.mode)
-        metric_dimensions = {
+        state = StreamState()
+        state.builder = PacketBuilder(self.ssrc, self.secret_key, self.mode)
+        state.metric_dimensions = {
                 "discord.guild.id": self.guild_id,
                 "discord.voicegateway.server": self.endpoint,
                 "discord.voicegateway.ip": self.ip,
                 "discord.voicegateway.port": self.port,
                 "discord.voicegateway.mode": self.mode
             }
+        state.last_heartbeat = time_millis()
+        return state
 
-        sequence = 0
-        path = None
-        file = None
-        timestamp = time_millis()
-        last_heartbeat = timestamp
-        last_heartbeat_sequence = sequence
-        while True:
-            # check if source has changed
-            paused = False
-            with self.lock:
-                if not self.streamer:
-                    break
-                if not path and not self.path:
-                    pass
-                elif path and not self.path:
-                    file.close()
-                    try:
-                        os.remove(path)
-                    except:
-                        pass
-                    file = None
-                    path = None
-                    print('VOICE CONNECTION ' + self.guild_id + ' stream completed')
-                    threading.Thread(target=self.__callback_playback_finished).start()
-                elif not path and self.path:
-                    path = self.path
-                    if not os.path.exists(path):
-                        print('VOICE CONNECTION ' + self.guild_id + ' skipping source because local file is not available')
-                        path = None
-                        self.path = None
-                        threading.Thread(target=self.__callback_playback_finished).start()
-                    else:
-                        file = wave.open(path, 'rb')
-                        if file.getframerate() != frame_rate or file.getnchannels() != channels or file.getsampwidth() != sample_width:
-                            print('VOICE CONNECTION ' + self.guild_id + ' skipping source because stream does not satisfy requirements')
-                            file.close()
-                            file = None
-                            try:
-                                os.remove(path)
-                            except:
-                                pass
-                            path = None
-                            self.path = None
-                            threading.Thread(target=self.__callback_playback_finished).start()
-                        else:
-                            print('VOICE CONNECTION ' + self.guild_id + ' streaming ' + path + ' (' + str(file.getnframes() / file.getframerate() / 60) + 'mins)')
-                            counter_streams.add(1, { "discord.guild.id": self.guild_id })
-                elif path and self.path and path != self.path:
-                    file.close()
-                    try:
-                        os.remove(path)
-                    except:
-                        pass
-                    file = None
-                    path = None
-                    print('VOICE CONNECTION ' + self.guild_id + ' stream changing source')
-                paused = self.paused
-            # encode a frame
-            opus_frame = None
-            if file and not paused:
-                pcm = file.readframes(desired_frame_size)
-                if len(pcm) == 0:
-                    with self.lock:
-                        self.path = None
-                effective_frame_size = len(pcm) // sample_width // channels
-                if effective_frame_size < desired_frame_size:
-                    pcm += b"\x00" * (desired_frame_size - effective_frame_size) * sample_width * channels
-                encoded_bytes = pyogg.opus.opus_encode(encoder, ctypes.cast(pcm, pyogg.opus.opus_int16_p), ctypes.c_int(desired_frame_size), ctypes.cast(buffer, pyogg.opus.c_uchar_p), pyogg.opus.opus_int32(len(buffer)))
-                opus_frame = bytes(buffer[:encoded_bytes])
-            else:
-                opus_frame = b"\xF8\xFF\xFE"
-            # send a frame
-            package = create_voice_package(sequence, sequence * desired_frame_size, self.ssrc, secret_box, opus_frame)
-            sequence += 1
-            try:
-                self.socket.sendto(package, (self.ip, self.port))
-            except OSError:
+    def __stream_frame(self, state):
+        # returns the next package to send, an empty one if the streamer is idle and should sleep until woken up, or None if the streamer should stop
+        # check if source has changed
+        paused = False
+        with self.lock:
+            if not self.streamer:
+                return None
+            if not state.path and not self.path:
                 pass
-            # check if we need to heartbeat and do so if necessary
-            if last_heartbeat + self.heartbeat_interval // 2 <= time_millis():
-                heartbeat = time_millis()
+            elif state.path and not self.path:
+                state.file.close()
+                state.file = None
+                cache_index.unpin(state.path)
+                state.path = None
+                print('VOICE CONNECTION ' + self.guild_id + ' stream completed')
+                self.__callback_playback_finished()
+            elif not state.path and self.path:
+                state.path = self.path
                 try:
-                    self.ws.send(json.dumps({ "op": 3, "d": heartbeat }))
-                except: # TODO limit to socket close exceptions
-                    pass
-                last_heartbeat = heartbeat
-                counter_streaming.add((sequence - last_heartbeat_sequence) * frame_duration, metric_dimensions)
-                last_heartbeat_sequence = sequence
-            # sleep
-            new_timestamp = time_millis()
-            sleep_time = frame_duration - (new_timestamp - timestamp)
-            if sleep_time < 0:
-                counter_real_time_violations.add(frame_duration, metric_dimensions)
-            elif sleep_time == 0:
-                pass
-            else:
-                time.sleep(sleep_time / 1000.0 * 2) # I have no fucking idea why multiplying this by two results in a clean audio stream!!! (times two is actually just a tad too slow, but not noticable by humans)
-                # current theory is that above when calculating effective and desired frame rates, we miss in some places a "divide by 2", reason is that we seem to pass the length in bytes, but as a short pointer. thats inconcistent
-            timestamp = new_timestamp
+                    state.file = open_packet_source(state.path)
+                except Exception:
+                    state.file = None
+                if not state.file and not os.path.exists(state.path):
+                    print('VOICE CONNECTION ' + self.guild_id + ' skipping source because local file is not available')
+                    state.path = None
+                    self.path = None
+                    self.__callback_playback_finished()
+                elif not state.file:
+                    print('VOICE CONNECTION ' + self.guild_id + ' skipping source because stream does not satisfy requirements')
+                    cache_index.remove(state.path)
+                    state.path = None
+                    self.path = None
+                    self.__callback_playback_finished()
+                else:
+                    cache_index.pin(state.path)
+                    duration_secs = state.file.get_duration_secs()
+                    print('VOICE CONNECTION ' + self.guild_id + ' streaming ' + state.path + ' (' + (str(duration_secs / 60) if duration_secs is not None else '?') + 'mins)')
+                    counter_streams.add(1, { "discord.guild.id": self.guild_id })
+            elif state.path and self.path and state.path != self.path:
+                state.file.close()
+                state.file = None
+                cache_index.unpin(state.path)
+                state.path = None
+                print('VOICE CONNECTION ' + self.guild_id + ' stream changing source')
+            if state.overlay_path != self.overlay_path:
+                if state.overlay_file:
+                    state.overlay_file.close()
+                    cache_index.unpin(state.overlay_path)
+                state.overlay_path = self.overlay_path
+                state.overlay_file = None
+                try:
+                    state.overlay_file = open_packet_source(state.overlay_path) if state.overlay_path else None
+                except Exception as e:
+                    print('VOICE CONNECTION ' + self.guild_id + ' dropping overlay because it cannot be opened: ' + str(e))
+                if state.overlay_file:
+                    cache_index.pin(state.overlay_path)
+                else:
+                    state.overlay_path = self.overlay_path = None
+            if state.file and self.seek_frame is not None:
+                if not state.file.seek(self.seek_frame):
+                    print('VOICE CONNECTION ' + self.guild_id + ' cannot seek past the end of the stream (or of what has been downloaded so far)')
+                self.seek_frame = None
+            self.position_secs = state.file.get_position_secs() if state.file else None
+            self.duration_secs = state.file.get_duration_secs() if state.file else None
+            paused = self.paused
+            volume = self.volume
+            normalize = self.normalize
+        # read a pre-encoded frame
+        opus_frame = None
+        if state.file and not paused:
+            opus_frame = state.file.read()
+            if opus_frame is None:
+                with self.lock:
+                    self.path = None
+        overlay_frame = None
+        if state.overlay_file:
+            overlay_frame = state.overlay_file.read()
+            if overlay_frame is None:
+                with self.lock:
+                    if self.overlay_path == state.overlay_path:
+                        self.overlay_path = None
+        # when there is nothing to play, send a few frames of silence to avoid interpolation on the clients, then stop speaking and go idle
+        if (state.file and not paused) or state.overlay_file:
+            state.silence_frames = 0
+            if state.idle:
+                state.idle = False
+                self.__speaking(True)
+        elif state.silence_frames < IDLE_SILENCE_FRAMES:
+            state.silence_frames += 1
+        else:
+            if not state.idle:
+                state.idle = True
+                self.__speaking(False)
+            return b''
+        if not opus_frame:
+            opus_frame = b"\xF8\xFF\xFE"
+        # adjust and mix in pcm only if necessary
+        if overlay_frame or ((volume != 1.0 or normalize) and opus_frame != b"\xF8\xFF\xFE"):
+            if not state.processor:
+                state.processor = FrameProcessor()
+            opus_frame = state.processor.process(opus_frame, overlay_frame, volume, normalize)
+        package = state.builder.build(state.sequence, state.sequence * desired_frame_size, opus_frame)
+        state.sequence += 1
+        return package
+
+    def __stream_send(self, state, package):
+        try:
+            self.socket.sendto(package, (self.ip, self.port))
+        except OSError:
+            pass
 
-        if path:
-            file.close()
+    def __stream_heartbeat(self, state):
+        # check if we need to heartbeat and do so if necessary, returns the milliseconds until the next heartbeat is due
+        now = time_millis()
+        if state.last_heartbeat + self.heartbeat_interval // 2 <= now:
             try:
-                os.remove(path)
-            except:
+                self.ws.send(json.dumps({ "op": 3, "d": now }))
+            except: # TODO limit to socket close exceptions
                 pass
-        pyogg.opus.opus_encoder_destroy(encoder)
-        
+            state.last_heartbeat = now
+            counter_streaming.add((state.sequence - state.last_heartbeat_sequence) * frame_duration, state.metric_dimensions)
+            state.last_heartbeat_sequence = state.sequence
+        return state.last_heartbeat + self.heartbeat_interval // 2 - now
+
+    def __speaking(self, speaking):
+        try:
+            self.ws.send(json.dumps({
+                "op": 5,
+                "d": {
+                    "speaking": 1 if speaking else 0,
+                    "delay": 0,
+                    "ssrc": self.ssrc
+                }
+            }))
+        except: # TODO limit to socket close exceptions
+            pass
+
+    def __stream_lateness(self, state, lateness, skipped):
+        histogram_frame_lateness.record(lateness / 1000000, state.metric_dimensions)
+        if lateness > 0:
+            counter_real_time_violations.add(lateness // 1000000, state.metric_dimensions)
+        if skipped > 0:
+            counter_skipped_frames.add(skipped, state.metric_dimensions)
+
+    def __stream_close(self, state):
+        if state.file:
+            state.file.close()
+            cache_index.unpin(state.path)
+        if state.overlay_file:
+            state.overlay_file.close()
+            cache_index.unpin(state.overlay_path)
+        if state.processor:
+            state.processor.close()
         print('VOICE CONNECTION ' + self.guild_id + ' stream closed')
 
+    def __stream(self):
+        state = self.__stream_open()
+        scheduler = FrameScheduler()
+        wakeup = threading.Event()
+        with self.lock:
+            self.wakeup = wakeup.set
+        while True:
+            package = self.__stream_frame(state)
+            if package is None:
+                break
+            if not package:
+                # idle, sleep until woken up or the next heartbeat is due
+                wakeup.wait(self.__stream_heartbeat(state) / 1000)
+                wakeup.clear()
+                scheduler = FrameScheduler()
+                continue
+            self.__stream_send(state, package)
+            self.__stream_heartbeat(state)
+            # sleep until the next frame is due
+            lateness, skipped = scheduler.wait()
+            self.__stream_lateness(state, lateness, skipped)
+        self.__stream_close(state)
+
+    async def __stream_async(self):
+        state = self.__stream_open()
+        scheduler = FrameScheduler()
+        wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            self.wakeup = lambda: loop.call_soon_threadsafe(wakeup.set)
+        while True:
+            # producing a frame reads files, may decode and mix, and takes the connection lock, so keep it off the loop
+            package = await loop.run_in_executor(voice_engine.media, self.__stream_frame, state)
+            if package is None:
+                break
+            if not package:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), self.__stream_heartbeat(state) / 1000)
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+                scheduler = FrameScheduler()
+                continue
+            self.__stream_send(state, package)
+            self.__stream_heartbeat(state)
+            delay, lateness, skipped = scheduler.next()
+            await asyncio.sleep(delay / 1000000000)
+            self.__stream_lateness(state, lateness, skipped)
+        await loop.run_in_executor(voice_engine.media, self.__stream_close, state)
+
     def __ws_on_open(self, ws):
         print('VOICE GATEWAY ' + self.guild_id + ' connection established')
 
     def __ws_on_message(self, ws, message):
+        payload = json.loads(message)
+        # discovering our public ip is a blocking http call, so do it before taking the lock the streamer and listener need
+        my_ip = (PUBLIC_IP or requests.get('https://ipv4.icanhazip.com/').text.strip()) if payload['op'] == 2 else None
         with self.lock:
-            payload = json.loads(message)
             if payload['op'] != 6: 
                 print('VOICE GATEWAY ' + self.guild_id + ' received message: ' + str(payload['op'])) # heartbeat acks are very spammy
             match payload['op']:
@@ -714,18 +2969,15 @@ class Connection:
                 case 6:
                     # print('VOICE GATEWAY heartbeat acknowledge') # this is quite spammy
                     if self.listener and not self.listener.is_alive():
-                        self.listener = threading.Thread(target=self.__listen)
-                        self.listener.start()
+                        self.listener = self.__start_background(self.__listen, self.__listen_async)
                     if self.streamer and not self.streamer.is_alive():
-                        self.streamer = threading.Thread(target=self.__stream)
-                        self.streamer.start()
+                        self.streamer = self.__start_streamer()
                 case 2:
                     print('VOICE GATEWAY ' + self.guild_id + ' received voice ready')
                     self.ssrc = payload['d']['ssrc']
                     self.ip = payload['d']['ip']
                     self.port = payload['d']['port']
                     modes = payload['d']['modes']
-                    my_ip = requests.get('https://ipv4.icanhazip.com/').text.strip()
                     my_port = None
                     print('VOICE CONNECTION ' + self.guild_id + ' opening UDP socket')
                     self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -744,7 +2996,7 @@ class Connection:
                             "data": {
                                 "address": my_ip,
                                 "port": my_port,
-                                "mode": "xsalsa20_poly1305"
+                                "mode": select_voice_mode(modes)
                             }
                         }
                     }))
@@ -753,19 +3005,10 @@ class Connection:
                     self.mode = payload['d']['mode']
                     self.secret_key = payload['d']['secret_key']
                     print('VOICE CONNECTION ' + self.guild_id + ' server ready')
-                    self.listener = threading.Thread(target=self.__listen)
-                    self.listener.start()
+                    self.listener = self.__start_background(self.__listen, self.__listen_async)
                     print('VOICE GATEWAY ' + self.guild_id + ' sending speaking')
-                    ws.send(json.dumps({
-                        "op": 5,
-                        "d": {
-                            "speaking": 1,
-                            "delay": 0,
-                            "ssrc": self.ssrc
-                        }
-                    }))
-                    self.streamer = threading.Thread(target=self.__stream)
-                    self.streamer.start()
+                    self.__speaking(True)
+                    self.streamer = self.__start_streamer()
                 case 5:
                     print('VOICE GATEWAY ' + self.guild_id + ' received speaking')
                     self.ssrc_to_client_user_id[payload['d']['ssrc']] = payload['d']['user_id']
@@ -793,62 +3036,57 @@ class Connection:
                 # fault must be in the code somewhere
                 # lets wait a bit to avoid busy loops and try again
                 self.__stop()
-                time.sleep(5)
-                self.__try_start()
+                self.__retry_later()
             case 4002: # failed to decode payload
                 # fault must be in the code somewhere
                 # lets wait a bit to avoid busy loops and try again
                 self.__stop()
-                time.sleep(5)
-                self.__try_start()
+                self.__retry_later()
             case 4003: # not authenticated
                 # we sent something before identifying, must be race condition
                 self.__stop()
-                time.sleep(5)
-                self.__try_start()
+                self.__retry_later()
             case 4004: # authentication failed
                 # the token is incorrect
                 # lets reconnect and get a new one
                 with self.lock:
                     self.token = None
                 self.__stop()
-                threading.Thread(target=self.__callback_reconnect).start()
+                self.__callback_reconnect()
             case 4005: # already authenticated
                 # we sent a second identify message, fault, must be in the code
                 # lets wait a bit to avoid busy loops and try again
                 self.__stop()
-                time.sleep(5)
-                self.__try_start()
+                self.__retry_later()
             case 4006: # session is no longer valid
                 # this can happen when we (only bot users) are alone for a while, then the session is killed
                 # lets reconnect and get a new session id, most likely we will not get a server update (and with it a new session id) until a real user joins, but that is fine, we will continue / complete connection as soon as a real user is here
                 with self.lock:
                     self.session_id = None
                 self.__stop()
-                threading.Thread(target=self.__callback_reconnect).start()
+                self.__callback_reconnect()
             case 4009: # session timeout
                 # lets try get a new one
                 with self.lock:
                     self.session_id = None
                 self.__stop()
-                threading.Thread(target=self.__callback_reconnect).start()
+                self.__callback_reconnect()
             case 4011: # server not found
                 # lets try get a new one
                 with self.lock:
                     self.endpoint = None
                 self.__stop()
-                threading.Thread(target=self.__callback_reconnect).start()
+                self.__callback_reconnect()
             case 4012: # unknown protocol
                 # not entirely sure what this refers to (the ws protocol, the first HTTP messages, the encoded frames), but either way, i guess the fault must lie in the code
                 # lets wait a bit to avoid busy loops and try again
                 self.__stop()
-                time.sleep(5)
-                self.__try_start()
+                self.__retry_later()
             case 4014: # disconnected (channel was deleted, you were kicked, voice server changed, or the main gateway session was dropped)
                 # thats a tricky one, the doc says not to try reconnecting, and we shouldn't open a new gateway connection, but we should try to reconnect on a discord level EXCEPT if we got kicked out of the channel (not the server)
                 # we wanna do that because in some cases we can recover by globally reconnecting again (voice server changed, session was dropped) and for situations it doesnt make sense (we got kicked from the server, channel was deleted), the global discord reconnect fails anyway
                 # lets just try to reconnect, and IF we got kicked from the channel, then lets hope we get the voice state changed thingy first, so we shut down ourselves actually
-                # threading.Thread(target=self.__callback_reconnect).start()
+                # self.__callback_reconnect()
                 self.__stop()
                 pass # lets NOT reconnect, otherwise stop is not working, gateway connection is closed before the voice state update event is sent!
             case 4015: # voice server crashed
@@ -858,20 +3096,30 @@ class Connection:
                 # fault must be in the code somewhere
                 # lets wait a bit to avoid busy loops and try again
                 self.__stop()
-                time.sleep(5)
-                self.__try_start()
+                self.__retry_later()
             case _: # something else
                 self.__stop()
-                time.sleep(5)
-                self.__try_start()
+                self.__retry_later()
     
+    def __retry_later(self):
+        # the engine schedules the retry on its loop instead of blocking one of its gateway workers for the backoff
+        if voice_engine:
+            voice_engine.call_later(5, self.__try_start)
+        else:
+            time.sleep(5)
+            self.__try_start()
+
     def __try_start(self):
         with self.lock:
             if self.ws or not self.channel_id or not self.session_id or not self.endpoint or not self.token:
                 return
             print('VOICE GATEWAY ' + self.guild_id + ' connection starting')
-            self.ws = websocket.WebSocketApp(self.endpoint + '?v=4', on_open=self.__ws_on_open, on_message=self.__ws_on_message, on_error=self.__ws_on_error, on_close=self.__ws_on_close)
-            threading.Thread(target=self.ws.run_forever).start()
+            if voice_engine:
+                self.ws = AsyncioWebSocketApp(self.endpoint + '?v=4', on_open=self.__ws_on_open, on_message=self.__ws_on_message, on_error=self.__ws_on_error, on_close=self.__ws_on_close)
+                self.ws.run_forever()
+            else:
+                self.ws = websocket.WebSocketApp(self.endpoint + '?v=4', on_open=self.__ws_on_open, on_message=self.__ws_on_message, on_error=self.__ws_on_error, on_close=self.__ws_on_close)
+                threading.Thread(target=self.ws.run_forever).start()
     
     def __stop(self):
         listener = None
@@ -884,7 +3132,8 @@ class Connection:
             streamer = self.streamer
             self.listener = None
             self.streamer = None
-            if self.socket:
+            self.__wake()
+            if self.socket and not voice_engine: # unblocks the listener thread, async listeners must unregister the socket first
                 self.socket.close()
             if self.ws:
                 self.ws.close()
@@ -893,6 +3142,8 @@ class Connection:
         if streamer:
             streamer.join()
         with self.lock:
+            if self.socket:
+                self.socket.close()
             self.socket = None
             self.ssrc = None
             self.ip = None
@@ -927,28 +3178,56 @@ class Connection:
         self.__try_start()
 
     def on_content_update(self, path):
-        def convert(file_from, file_to):
-            observed_subprocess_run(['ffmpeg', '-i', file_from, '-ar', str(frame_rate), '-ac', str(channels), '-sample_fmt', 's' + str(sample_width * 8), '-y', file_to]).check_returncode()
-        if path.endswith('.wav'):
-            file = wave.open(path, "rb")
-            all_ok = file.getframerate() == frame_rate and file.getnchannels() == channels and file.getsampwidth() == sample_width
-            file.close()
-            if not all_ok:
-                to_path = '_' + path.rsplit('.', 1)[0] + '.wav'
-                convert(path, to_path)
-                os.remove(path)
-                os.rename(to_path, path)
-        else:
-            to_path = path.rsplit('.', 1)[0] + '.wav'
-            convert(path, to_path)
-            path = to_path
+        if not path.endswith('.' + PACKET_FILE_EXTENSION):
+            packet_path = path.rsplit('.', 1)[0] + '.' + PACKET_FILE_EXTENSION
+            convert_to_packet_file(path, packet_path)
+            path = packet_path
+        self.__play(path)
+
+    def on_content_stream(self, path):
+        self.__play(path)
 
+    def __play(self, path):
         with self.lock:
             self.path = path
             self.paused = False
+            self.seek_frame = None
+            self.__wake()
         self.__save()
         self.__try_start()
 
+    def set_volume(self, volume, normalize):
+        with self.lock:
+            self.volume = volume
+            self.normalize = normalize
+        self.__save()
+
+    def set_voice_activity_gate(self, settings):
+        # the listener picks up the new settings with the next frame
+        with self.lock:
+            self.gate.update(settings)
+        self.__save()
+
+    def overlay(self, path):
+        with self.lock:
+            self.overlay_path = path
+            self.__wake()
+
+    def seek(self, position_secs):
+        # takes effect with the next frame
+        with self.lock:
+            if not self.path:
+                return False
+            self.seek_frame = int(position_secs * 1000 / frame_duration)
+            if self.position_secs is not None and self.duration_secs is not None and self.seek_frame * frame_duration / 1000 <= self.duration_secs:
+                self.position_secs = self.seek_frame * frame_duration / 1000 # otherwise the streamer reports where it ended up
+            self.__wake() # an idle streamer (like while paused) applies the seek right away and goes back to sleep
+            return True
+
+    def get_position(self):
+        with self.lock:
+            return self.position_secs if self.path else None, self.duration_secs if self.path else None, self.paused
+
     def pause(self):
         with self.lock:
             self.paused = True
@@ -957,6 +3236,7 @@ class Connection:
     def resume(self):
         with self.lock:
             self.paused = False
+            self.__wake()
         self.__save()
     
     def is_connecting(self):
@@ -991,6 +3271,22 @@ meter.create_observable_gauge('discord.gateway.voice.connections.concurrent', [g
 def ping():
     return 'pong'
 
+@app.route('/health', methods=['GET'])
+def health():
+    with contexts_lock:
+        connections = list(contexts.values())
+    with recordings_lock:
+        recording_count = len(recordings)
+    return {
+        'worker': VOICE_WORKER,
+        'pid': os.getpid(),
+        'guilds': len(connections),
+        'connections': len([context for context in connections if context.is_connected()]),
+        'recordings': recording_count,
+        'cache_size': cache_index.get_size(),
+        'cache_files': cache_index.get_count()
+    }
+
 @app.route('/events/voice_state_update', methods=['POST'])
 def voice_state_update():
     if not request.headers.get('x-authorization'): return Response('Unauthorized', status=401)
@@ -1027,21 +3323,23 @@ def voice_content_update(guild_id):
     elif request.headers['content-type'] == 'application/json':
         body = request.json
         context = get_connection(guild_id)
+        job = prefetch_scheduler.preempt(body['url']) if prefetch_scheduler else None
+        error = None
         try:
-            context.on_content_update(resolve_url(guild_id, body['url']))
-        except yt_dlp.utils.DownloadError as e:
-            if 'Private video' in str(e):
-                return Response('Private video', status = 403)
-            elif 'blocked' in str(e) or 'copyright' in str(e) or "in your country" in str(e):
-                return Response('Blocked video', status = 451)
-            elif 'inappropriate' in str(e) or 'confirm your age' in str(e):
-                return Response('Age-restricted video', status = 451)
-            elif 'account' in str(e) and 'terminated' in str(e):
-                return Response('Video not found', status = 404)
+            # ffmpeg pulls progressive sources itself, so they cannot be throttled and a bandwidth limit falls back to regular downloads
+            if PROGRESSIVE_PLAYBACK and DOWNLOAD_BANDWIDTH_LIMIT <= 0 and (body['url'].startswith('http://') or body['url'].startswith('https://')):
+                context.on_content_stream(resolve_url_progressive(guild_id, body['url']))
             else:
-                return Response('Video not found', status = 404)
-        except Exception:
+                context.on_content_update(resolve_url(guild_id, body['url']))
+        except yt_dlp.utils.DownloadError as e:
+            error, status = describe_download_error(e)
+            return Response(error, status = status)
+        except Exception as e:
+            error = str(e)
             return Response('Internal Error', status = 500)
+        finally:
+            if prefetch_scheduler:
+                prefetch_scheduler.release(job, error)
         return 'Success'
     else:
         return Response('Invalid Request', status=400)
@@ -1053,21 +3351,24 @@ def voice_content_lookahead(guild_id):
     if request.headers['x-authorization'] != os.environ['DISCORD_API_TOKEN']: return Response('Forbidden', status=403)
     body = request.json
     try:
-        resolve_url(guild_id, body['url'])
-    except yt_dlp.utils.DownloadError as e:
-        if 'Private video' in str(e):
-            return Response('Private video', status = 403)
-        elif 'blocked' in str(e) or 'copyright' in str(e) or "in your country" in str(e):
-            return Response('Blocked video', status = 451)
-        elif 'inappropriate' in str(e) or 'confirm your age' in str(e):
-            return Response('Age-restricted video', status = 451)
-        elif 'account' in str(e) and 'terminated' in str(e):
-            return Response('Video not found', status = 404)
-        else:
-            return Response('Video not found', status = 404)
-    except Exception:
-        return Response('Internal Error', status = 500)
-    return 'Success'
+        prefetch_scheduler.submit(guild_id, body['url'], int(body.get('priority', 0)))
+    except RuntimeError:
+        return Response('Too Many Requests', status = 429)
+    return Response('Accepted', status = 202)
+
+@app.route('/guilds/<guild_id>/voice/lookahead', methods=['GET'])
+def voice_content_lookahead_status(guild_id):
+    if not request.headers.get('x-authorization'): return Response('Unauthorized', status=401)
+    if request.headers['x-authorization'] != os.environ['DISCORD_API_TOKEN']: return Response('Forbidden', status=403)
+    url = request.args.get('url')
+    if not url:
+        return Response('Invalid Request', status=400)
+    job = prefetch_scheduler.get(url)
+    if job:
+        return { 'status': job.status, 'error': job.error }
+    if os.path.exists(STORAGE_DIRECTORY + '/' + get_cache_filename_prefix(url) + '.' + PACKET_FILE_EXTENSION):
+        return { 'status': 'ready', 'error': None }
+    return Response('Not Found', status = 404)
 
 @app.route('/guilds/<guild_id>/voice/pause', methods=['POST'])
 def voice_pause(guild_id):
@@ -1085,6 +3386,73 @@ def voice_resume(guild_id):
     context.resume()
     return 'Success'
 
+@app.route('/guilds/<guild_id>/voice/seek', methods=['POST'])
+def voice_seek(guild_id):
+    if not request.headers.get('x-authorization'): return Response('Unauthorized', status=401)
+    if request.headers['x-authorization'] != os.environ['DISCORD_API_TOKEN']: return Response('Forbidden', status=403)
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return Response('Invalid Request', status=400)
+    position_secs = body.get('position_secs')
+    if isinstance(position_secs, bool) or not isinstance(position_secs, (int, float)) or not math.isfinite(position_secs) or position_secs < 0:
+        return Response('Invalid Request', status=400)
+    context = get_connection(guild_id)
+    if not context.seek(position_secs):
+        return Response('Not Playing', status=409)
+    return 'Success'
+
+@app.route('/guilds/<guild_id>/voice/position', methods=['GET'])
+def voice_position(guild_id):
+    if not request.headers.get('x-authorization'): return Response('Unauthorized', status=401)
+    if request.headers['x-authorization'] != os.environ['DISCORD_API_TOKEN']: return Response('Forbidden', status=403)
+    context = get_connection(guild_id)
+    position_secs, duration_secs, paused = context.get_position()
+    return { 'position_secs': position_secs, 'duration_secs': duration_secs, 'paused': paused }
+
+@app.route('/guilds/<guild_id>/voice/volume', methods=['POST'])
+def voice_volume(guild_id):
+    if not request.headers.get('x-authorization'): return Response('Unauthorized', status=401)
+    if request.headers['x-authorization'] != os.environ['DISCORD_API_TOKEN']: return Response('Forbidden', status=403)
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return Response('Invalid Request', status=400)
+    volume = body.get('volume', 1.0)
+    normalize = body.get('normalize', False)
+    if isinstance(volume, bool) or not isinstance(volume, (int, float)) or not math.isfinite(volume) or volume < 0 or volume > 4 or not isinstance(normalize, bool):
+        return Response('Invalid Request', status=400)
+    context = get_connection(guild_id)
+    context.set_volume(float(volume), normalize)
+    return 'Success'
+
+@app.route('/guilds/<guild_id>/voice/vad', methods=['POST'])
+def voice_vad(guild_id):
+    if not request.headers.get('x-authorization'): return Response('Unauthorized', status=401)
+    if request.headers['x-authorization'] != os.environ['DISCORD_API_TOKEN']: return Response('Forbidden', status=403)
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return Response('Invalid Request', status=400)
+    context = get_connection(guild_id)
+    try:
+        context.set_voice_activity_gate(body)
+    except ValueError:
+        return Response('Invalid Request', status=400)
+    return 'Success'
+
+@app.route('/guilds/<guild_id>/voice/overlay', methods=['POST'])
+def voice_overlay(guild_id):
+    if not request.headers.get('x-authorization'): return Response('Unauthorized', status=401)
+    if request.headers['x-authorization'] != os.environ['DISCORD_API_TOKEN']: return Response('Forbidden', status=403)
+    body = request.json
+    context = get_connection(guild_id)
+    try:
+        context.overlay(resolve_url(guild_id, body['url']) if body.get('url') else None)
+    except yt_dlp.utils.DownloadError as e:
+        error, status = describe_download_error(e)
+        return Response(error, status = status)
+    except Exception:
+        return Response('Internal Error', status = 500)
+    return 'Success'
+
 @app.route('/guilds/<guild_id>/voice/connection', methods=['GET'])
 def voice_is_connected(guild_id):
     if not request.headers.get('x-authorization'): return Response('Unauthorized', status=401)
@@ -1106,27 +3474,232 @@ def audio(guild_id, channel_id, user_id, nonce):
     # authenticate?
     # attacker would have to know guild_id, channel_id (needs to be in the server), user_id (needs to be in the server or friend), and guess the right nonce, and access it in real-time
     # they would get a small random audio chunk
-    for extension in ['wav', 'mp3']:
+    tail = request.args.get('tail') == 'true'
+    for extension in ['wav', 'mp3', 'ogg']:
         path = generate_audio_file_path(guild_id, channel_id, user_id, nonce, extension)
-        if os.path.exists(path):
-            with open(path, 'rb') as bites:
-                return send_file(io.BytesIO(bites.read()), mimetype='audio/' + extension)
+        if not os.path.exists(path):
+            continue
+        if tail and is_recording(path):
+            return Response(tail_audio_file(path, extension), mimetype='audio/' + extension)
+        try:
+            return send_file(os.path.abspath(path), mimetype='audio/' + extension, conditional=True, etag=True)
+        except FileNotFoundError:
+            pass # converted or cleaned up in the meantime
     return Response('Not Found', status=404)
 
-def cleanup():
-    for file in os.listdir(STORAGE_DIRECTORY):
-        if os.path.getmtime(STORAGE_DIRECTORY + '/' + file) + 60 * 15 < time_seconds():
-            print('CLEANING ' + file)
-            try:
-                os.remove(STORAGE_DIRECTORY + '/' + file)
-            except:
-                pass
+def tail_audio_file(path, extension, chunk_size = 1024 * 16, timeout = 1000 * 30):
+    # streams a recording while it is still being written, until it is complete
+    with open(path, 'rb') as file:
+        header_patched = extension != 'wav'
+        last_progress = time_millis()
+        while True:
+            recording = is_recording(path)
+            chunk = file.read(chunk_size)
+            if not header_patched and len(chunk) < 44 and recording:
+                file.seek(-len(chunk), os.SEEK_CUR) # wait for the complete header
+                chunk = b''
+            elif not header_patched and chunk:
+                # the sizes in the header are only known once the recording is complete, mark them as unknown for streaming
+                chunk = bytearray(chunk)
+                if len(chunk) >= 44:
+                    struct.pack_into('<I', chunk, 4, 0xFFFFFFFF)
+                    struct.pack_into('<I', chunk, 40, 0xFFFFFFFF)
+                chunk = bytes(chunk)
+                header_patched = True
+            if chunk:
+                last_progress = time_millis()
+                yield chunk
+            elif not recording or last_progress + timeout < time_millis():
+                break
+            else:
+                time.sleep(frame_duration / 1000)
 
 def cleanup_loop():
+    last_sweep = time_millis()
     while True:
-        cleanup()
+        cache_index.evict()
+        try:
+            cache_index.save()
+        except Exception as exception:
+            print('VOICE CACHE cannot write index: ' + str(exception))
+        if last_sweep + CACHE_SWEEP_INTERVAL < time_millis():
+            cache_index.sweep()
+            last_sweep = time_millis()
         time.sleep(60)
 
+def get_worker_index(guild_id, workers):
+    # stable across restarts (unlike hash), so a guild always comes back to the worker that has its state
+    return int(hashlib.sha256(str(guild_id).encode('utf-8')).hexdigest(), 16) % workers
+
+def get_worker_directory(directory, index):
+    return directory + '/worker-' + str(index)
+
+counter_worker_restarts = meter.create_counter(name = 'discord.gateway.voice.workers.restarts', description = 'Number of worker processes restarted after they exited', unit="count")
+
+hop_by_hop_headers = set(['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers', 'transfer-encoding', 'upgrade', 'host', 'content-length'])
+
+class Worker:
+    index = None
+    port = None
+    process = None
+
+    def __init__(self, index, port):
+        self.index = index
+        self.port = port
+
+    def get_url(self, path):
+        return 'http://127.0.0.1:' + str(self.port) + path
+
+class Supervisor:
+    # runs the service in several worker processes, so streaming scales with cores instead of contending for one interpreter lock,
+    # every guild is owned by one worker (by a stable hash of its id) and all guild routes are proxied to it,
+    # every worker has its own state directory but they share the cache (see CACHE_OWNER and DownloadLock), health is aggregated here, metrics are exported by the workers themselves
+    lock = None
+    workers = None
+    session = None
+    stopping = False
+
+    def __init__(self, count):
+        self.lock = threading.Lock()
+        self.workers = [Worker(index, VOICE_WORKER_PORT_BASE + index) for index in range(count)]
+        self.session = requests.Session()
+
+    def start(self):
+        self.__distribute_state_files()
+        with self.lock:
+            for worker in self.workers:
+                self.__spawn(worker)
+        threading.Thread(target=self.__watch).start()
+
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+            for worker in self.workers:
+                worker.process.terminate()
+        for worker in self.workers:
+            worker.process.wait()
+
+    def __distribute_state_files(self):
+        # guilds may have been owned by another worker (or a single process) before, so their state moves to their worker now
+        for worker in self.workers:
+            os.makedirs(get_worker_directory(SESSION_DIRECTORY, worker.index), exist_ok=True)
+        directories = [SESSION_DIRECTORY] + [SESSION_DIRECTORY + '/' + name for name in os.listdir(SESSION_DIRECTORY) if name.startswith('worker-')]
+        for directory in directories:
+            if not os.path.isdir(directory):
+                continue
+            for file in os.listdir(directory):
+                if not file.startswith('.state.') or not file.endswith('.json'):
+                    continue
+                target = get_worker_directory(SESSION_DIRECTORY, get_worker_index(file[len('.state.'):len(file) - len('.json')], len(self.workers)))
+                if os.path.normpath(directory) != os.path.normpath(target):
+                    os.replace(directory + '/' + file, target + '/' + file)
+
+    def __spawn(self, worker):
+        env = dict(os.environ)
+        env['VOICE_WORKERS'] = str(1)
+        env['VOICE_WORKER'] = str(worker.index)
+        env['PORT'] = str(worker.port)
+        env['STATE_STORAGE_DIRECTORY'] = get_worker_directory(SESSION_DIRECTORY, worker.index)
+        command = [sys.executable, '-u', os.path.abspath(__file__)]
+        instrument = shutil.which('opentelemetry-instrument')
+        if instrument:
+            command = [instrument] + command # like the supervisor itself in the container
+        worker.process = subprocess.Popen(command, env=env)
+        print('VOICE SUPERVISOR worker ' + str(worker.index) + ' started (pid ' + str(worker.process.pid) + ', port ' + str(worker.port) + ')')
+
+    def __watch(self):
+        while True:
+            time.sleep(VOICE_WORKER_RESTART_DELAY / 1000)
+            with self.lock:
+                if self.stopping:
+                    return
+                for worker in self.workers:
+                    returncode = worker.process.poll()
+                    if returncode is None:
+                        continue
+                    print('VOICE SUPERVISOR worker ' + str(worker.index) + ' exited (' + str(returncode) + '), restarting')
+                    counter_worker_restarts.add(1)
+                    self.__spawn(worker)
+
+    def get_worker(self, guild_id):
+        return self.workers[get_worker_index(guild_id, len(self.workers))]
+
+    def proxy(self, guild_id):
+        worker = self.get_worker(guild_id)
+        url = worker.get_url(request.path + ('?' + request.query_string.decode('utf-8') if request.query_string else ''))
+        headers = { key: value for key, value in request.headers.items() if key.lower() not in hop_by_hop_headers }
+        try:
+            upstream = self.session.request(request.method, url, data=request.get_data(), headers=headers, stream=True, timeout=(5, None))
+        except requests.exceptions.ConnectionError:
+            return Response('Service Unavailable', status=503)
+        # passed through as is (also chunked, like tailed recordings), the content length must match the raw body
+        headers = [(key, value) for key, value in upstream.headers.items() if key.lower() not in hop_by_hop_headers or key.lower() == 'content-length']
+        return Response(upstream.raw.stream(1024 * 16, decode_content=False), status=upstream.status_code, headers=headers)
+
+    def get_health(self):
+        workers = []
+        for worker in self.workers:
+            try:
+                response = self.session.get(worker.get_url('/health'), timeout=5)
+                response.raise_for_status()
+                workers.append(dict(response.json(), healthy=True))
+            except Exception as e:
+                workers.append({ 'worker': str(worker.index), 'healthy': False, 'error': str(e) })
+        healthy = [worker for worker in workers if worker['healthy']]
+        owner = next((worker for worker in healthy if worker['worker'] == '0'), None) # the cache is shared, only its owner knows all files
+        return {
+            'healthy': len(healthy) == len(workers),
+            'workers': workers,
+            'guilds': sum(worker['guilds'] for worker in healthy),
+            'connections': sum(worker['connections'] for worker in healthy),
+            'recordings': sum(worker['recordings'] for worker in healthy),
+            'cache_size': owner['cache_size'] if owner else None,
+            'cache_files': owner['cache_files'] if owner else None
+        }
+
+supervisor = None
+supervisor_app = Flask(__name__ + '.supervisor')
+
+@supervisor_app.route('/ping', methods=['GET'])
+def supervisor_ping():
+    return 'pong'
+
+@supervisor_app.route('/health', methods=['GET'])
+def supervisor_health():
+    health = supervisor.get_health()
+    return Response(json.dumps(health), status=200 if health['healthy'] else 503, mimetype='application/json')
+
+@supervisor_app.route('/events/<event>', methods=['POST'])
+def supervisor_event(event):
+    body = request.get_json(silent=True)
+    if not body or not body.get('guild_id'):
+        return Response('Invalid Request', status=400)
+    return supervisor.proxy(body['guild_id'])
+
+@supervisor_app.route('/guilds/<guild_id>/<path:rest>', methods=['GET', 'POST'])
+def supervisor_guild(guild_id, rest):
+    return supervisor.proxy(guild_id)
+
+def get_workers_alive(options):
+    if supervisor:
+        with supervisor.lock:
+            yield metrics.Observation(len([worker for worker in supervisor.workers if worker.process and worker.process.poll() is None]))
+
+meter.create_observable_gauge('discord.gateway.voice.workers', [get_workers_alive])
+
+def run_supervisor():
+    global supervisor
+    supervisor = Supervisor(VOICE_WORKERS)
+    supervisor.start()
+    def terminate(signum, frame):
+        print('VOICE SUPERVISOR stopping workers')
+        supervisor.stop()
+        os._exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    print('VOICE ready (supervising ' + str(VOICE_WORKERS) + ' workers)')
+    supervisor_app.run(port=HTTP_PORT, threaded=True)
+
 def main():
     memory_limit = int(os.environ.get('MEMORY_LIMIT', str(0)))
     if memory_limit > 0:
@@ -1134,13 +3707,28 @@ def main():
     if not pyogg.PYOGG_OPUS_AVAIL or not pyogg.PYOGG_OPUS_FILE_AVAIL:
         print('VOICE not ready (opus not available)')
         exit(1)
+    if VOICE_WORKERS > 1:
+        run_supervisor()
+        return
+    start()
+    print('VOICE ready')
+    # app.run(port=HTTP_PORT, ssl_context='adhoc', threaded=True)
+    app.run(port=HTTP_PORT, threaded=True)
+
+def start():
+    # everything but the http server, so the service can also be driven in-process (like by the benchmark)
+    global voice_engine, frame_ticker, callback_dispatcher, prefetch_scheduler
+    callback_dispatcher = CallbackDispatcher()
+    prefetch_scheduler = PrefetchScheduler()
+    if VOICE_ENGINE == 'asyncio':
+        voice_engine = AsyncioVoiceEngine()
+    if VOICE_SENDER == 'ticker':
+        frame_ticker = FrameTicker()
     for file in os.listdir(SESSION_DIRECTORY):
         if file.startswith('.state.') and file.endswith('.json'):
             get_connection(file[len('.state.'):len(file) - len('.json')])
+    cache_index.load()
     threading.Thread(target=cleanup_loop).start()
-    print('VOICE ready')
-    # app.run(port=HTTP_PORT, ssl_context='adhoc', threaded=True)
-    app.run(port=HTTP_PORT, threaded=True)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,44 @@
+# the packet builder encrypts straight from frames of packet files, so it must accept views into them and not only bytes
+#
+#   python -m pytest tests
+
+import os
+import sys
+import tempfile
+import pytest
+
+os.environ.setdefault('CACHE_DIRECTORY', tempfile.mkdtemp(prefix = 'philbot-voice-test.'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'philbot-voice'))
+import voice
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+secret_key = bytes(range(32))
+
+def read_frame_view(frame):
+    # the frame of a packet file as a slice of a larger buffer
+    path = voice.STORAGE_DIRECTORY + '/test.' + voice.PACKET_FILE_EXTENSION
+    writer = voice.PacketFileWriter(path)
+    writer.write(b'\xFC' + bytes(10))
+    writer.write(frame)
+    writer.close()
+    reader = voice.PacketFileReader(path)
+    reader.read()
+    data = bytearray(b'\x00\x00' + reader.read())
+    reader.close()
+    os.remove(path)
+    return memoryview(data)[2:]
+
+@pytest.mark.parametrize('mode', [ 'xsalsa20_poly1305', 'aead_xchacha20_poly1305_rtpsize', 'aead_aes256_gcm_rtpsize' ])
+@pytest.mark.parametrize('software_aes', [ False, True ])
+def test_build_from_memoryview(mode, software_aes):
+    if software_aes and mode != 'aead_aes256_gcm_rtpsize':
+        pytest.skip('only aes256 gcm has a software fallback')
+    frame = b'\xFC' + bytes(range(1, 120))
+    view = read_frame_view(frame)
+    builder = voice.PacketBuilder(42, secret_key, mode)
+    if software_aes:
+        builder.aesgcm = AESGCM(builder.key)
+    package = bytes(builder.build(7, 7 * voice.desired_frame_size, view))
+    sequence, timestamp, ssrc, voice_chunk = voice.PacketOpener(secret_key, mode).open(package)
+    assert (sequence, timestamp, ssrc) == (7, 7 * voice.desired_frame_size, 42)
+    assert voice_chunk == frame